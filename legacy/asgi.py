@@ -0,0 +1,296 @@
+# ASGI entry point:
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+#
+# Every route of server.py is served by handing the request to the Flask app on
+# a bounded thread pool. The long-poll route GET /rooms/<room_id>/wait is served
+# on the event loop itself instead: a parked poller is a coroutine waiting on an
+# asyncio.Event, not a thread, so thousands of idle clients cost next to nothing.
+
+import asyncio
+import contextvars
+import io
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import server
+
+config = server.config
+
+# threads running Flask handlers, and how many requests may wait for one
+executor_threads = config["asgi_threads"] if "asgi_threads" in config else 16
+max_pending = config["asgi_max_pending"] if "asgi_max_pending" in config else 512
+
+wait_route = re.compile(r"^/rooms/([^/]+)/wait$")
+
+executor = ThreadPoolExecutor(max_workers=executor_threads, thread_name_prefix="asgi-wsgi")
+
+
+# Fans room changes from the notifier's threads out to coroutines. Each room has
+# one asyncio.Event that is swapped for a fresh one on every change, and changes
+# that land before the loop got to the previous one are coalesced.
+class RoomWaiters:
+    def __init__(self):
+        self.loop = None
+        self.lock = threading.Lock()
+        # room ids with a wake up already scheduled on the loop
+        self.pending = set()
+        # room id -> Event the room's pollers are waiting on
+        self.events = {}
+
+    def start(self, loop):
+        self.loop = loop
+        server.db.changes.add_listener(self.on_change)
+
+    # called on whichever thread changed the room
+    def on_change(self, room_id):
+        if self.loop is None:
+            return
+        with self.lock:
+            if room_id in self.pending:
+                return
+            self.pending.add(room_id)
+        self.loop.call_soon_threadsafe(self.wake, room_id)
+
+    def wake(self, room_id):
+        with self.lock:
+            self.pending.discard(room_id)
+        event = self.events.pop(room_id, None)
+        if event is not None:
+            event.set()
+
+    def get_event(self, room_id) -> asyncio.Event:
+        event = self.events.get(room_id)
+        if event is None:
+            event = self.events[room_id] = asyncio.Event()
+        return event
+
+    # returns whether the room changed before the timeout
+    async def wait(self, room_id, version, cursor, timeout) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            # take the event before checking, so a change in between still wakes us
+            event = self.get_event(room_id)
+            if server.db.room_changed(room_id, version, cursor):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+
+
+waiters = RoomWaiters()
+pending = 0
+
+
+def build_environ(scope, body) -> dict:
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "SERVER_NAME": scope["server"][0] if scope.get("server") else "localhost",
+        "SERVER_PORT": str(scope["server"][1]) if scope.get("server") and scope["server"][1] is not None else "80",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name == "CONTENT_LENGTH":
+            continue
+        else:
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+
+    return environ
+
+
+# runs on the pool: calls Flask and, unless the response streams, reads the whole body
+def start_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info = None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+    iterator = server.app(environ, start_response)
+    streamed = not any(k == b"content-length" for k, _ in response["headers"])
+    if streamed:
+        return response, iterator, None
+
+    try:
+        body = b"".join(iterator)
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+    return response, None, body
+
+
+def next_chunk(iterator):
+    for chunk in iterator:
+        if len(chunk) > 0:
+            return chunk
+    return None
+
+
+def close_iterator(iterator):
+    if hasattr(iterator, "close"):
+        iterator.close()
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def send_simple(send, status, body, content_type = b"application/json"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type),
+            (b"content-length", str(len(body)).encode()),
+            (b"access-control-allow-origin", b"*"),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def serve_wsgi(scope, receive, send):
+    global pending
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    # backpressure: a request that would only queue behind a full pool is turned away
+    if pending >= max_pending:
+        await send_simple(send, 503, json.dumps({"tick_rate": server.hits.get_tick_rate()}).encode())
+        return
+
+    loop = asyncio.get_running_loop()
+    # a streamed response may be resumed on another pool thread; running every
+    # step in one context keeps Flask's request context visible across them
+    context = contextvars.Context()
+    pending += 1
+    try:
+        response, iterator, content = await loop.run_in_executor(executor, context.run, start_wsgi, build_environ(scope, body))
+        await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+
+        if iterator is None:
+            await send({"type": "http.response.body", "body": content})
+            return
+
+        try:
+            while True:
+                chunk = await loop.run_in_executor(executor, context.run, next_chunk, iterator)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await loop.run_in_executor(executor, context.run, close_iterator, iterator)
+    finally:
+        pending -= 1
+
+
+def long_poll_updates(room_id, args, changed) -> dict:
+    # the event backfill may need a pooled connection
+    with server.app.app_context():
+        return server.room_updates(room_id, args["version"], args["cursor"], args["username"], changed)
+
+
+def query_arg(query, name, cast, default = None):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        return cast(values[0])
+    except ValueError:
+        return default
+
+
+async def serve_long_poll(scope, send, room_id):
+    start = time.perf_counter()
+    query = parse_qs(scope["query_string"].decode("latin-1"))
+    args = {
+        "version": query_arg(query, "version", int, -1),
+        "cursor": query_arg(query, "cursor", int),
+        "username": query_arg(query, "username", str),
+        "timeout": max(0.0, min(query_arg(query, "timeout", float, server.long_poll_max_timeout), server.long_poll_max_timeout)),
+    }
+
+    # same as the Flask routes: nothing is kept for rooms that aren't configured
+    try:
+        known = int(room_id) in server.db.room_infos
+    except ValueError:
+        known = False
+    if not known:
+        await send_simple(send, 404, b"{}")
+        return
+
+    changed = await waiters.wait(int(room_id), args["version"], args["cursor"], args["timeout"])
+
+    loop = asyncio.get_running_loop()
+    package = await loop.run_in_executor(executor, long_poll_updates, room_id, args, changed)
+    await send_simple(send, 200, json.dumps(package, separators=(",", ":")).encode())
+
+    server.request_count.inc("/rooms/<room_id>/wait", "GET", 200)
+    server.request_latency.observe(time.perf_counter() - start, "/rooms/<room_id>/wait", "GET")
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            waiters.start(asyncio.get_running_loop())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] != "http":
+        return
+
+    # servers that skip lifespan still get the loop hooked up on the first request
+    if waiters.loop is None:
+        waiters.start(asyncio.get_running_loop())
+
+    match = wait_route.match(scope["path"])
+    if match is not None and scope["method"] == "GET":
+        await serve_long_poll(scope, send, match.group(1))
+        return
+
+    await serve_wsgi(scope, receive, send)
@@ -0,0 +1,368 @@
+# Starts server.py in a scratch copy of this folder and drives it with virtual
+# players doing the real client loop: position update, room poll, event post and
+# poll, and now and then a save get/post. Prints per route throughput and
+# p50/p95/p99 latency, the share of request time spent in SQLite and the
+# server's RSS, and writes it all as JSON so runs can be compared.
+#
+#   python3 bench/load_test.py --players 500 --duration 30 --out results.json
+#   python3 bench/load_test.py --players 500 --sync --compare results.json
+#
+# Pass --url to hit a server that is already running instead. The load generator
+# is Python too, so at high player counts compare the client side latencies with
+# the server's own request_ms in the "db" section before blaming the server.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+legacy_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+costumes = ["tankman", "paco", "santa", "elf", "snowman", "reindeer"]
+event_types = ["emote", "sticker", "present_opened", "marshmallow"]
+
+
+def percentile(samples, fraction) -> float:
+    if len(samples) == 0:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class RouteStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # route -> list of latencies in ms
+        self.samples = {}
+        # route -> failed or non 2xx/304 requests
+        self.errors = {}
+
+    def record(self, route, latency_ms, ok):
+        with self.lock:
+            self.samples.setdefault(route, []).append(latency_ms)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, elapsed) -> dict:
+        routes = {}
+        with self.lock:
+            for route, samples in self.samples.items():
+                samples = sorted(samples)
+                routes[route] = {
+                    "count": len(samples),
+                    "errors": self.errors.get(route, 0),
+                    "rps": len(samples) / elapsed,
+                    "mean_ms": sum(samples) / len(samples),
+                    "p50_ms": percentile(samples, 0.50),
+                    "p95_ms": percentile(samples, 0.95),
+                    "p99_ms": percentile(samples, 0.99),
+                    "max_ms": samples[-1],
+                }
+        return routes
+
+
+class Player:
+    def __init__(self, index, args):
+        self.username = f"bench_{index:05d}"
+        self.room_id = args.room
+        self.x = random.uniform(0, 2000)
+        self.y = random.uniform(0, 1200)
+        self.costume = random.choice(costumes)
+        self.version = None
+        self.cursor = None
+        self.save_etag = None
+        self.steps = 0
+        self.next_step = time.perf_counter() + random.uniform(0, args.tick_ms / 1000)
+
+    def move(self):
+        self.x = min(2000, max(0, self.x + random.uniform(-40, 40)))
+        self.y = min(1200, max(0, self.y + random.uniform(-40, 40)))
+
+
+class LoadTest:
+    def __init__(self, args, url):
+        self.args = args
+        self.url = url
+        self.stats = RouteStats()
+        self.stop = threading.Event()
+
+    def request(self, session, route, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, self.url + path, timeout=self.args.timeout, **kwargs)
+            ok = response.status_code < 300 or response.status_code == 304
+        except requests.RequestException:
+            response = None
+            ok = False
+        self.stats.record(route, (time.perf_counter() - start) * 1000, ok)
+        return response if ok else None
+
+    def step(self, session, player):
+        args = self.args
+        room = f"/rooms/{player.room_id}"
+        player.move()
+        player.steps += 1
+
+        outgoing = []
+        if random.random() < args.event_chance:
+            outgoing.append({"type": random.choice(event_types), "data": {"step": player.steps}})
+
+        position = {"name": player.username, "x": player.x, "y": player.y, "sx": random.choice([-1, 1]), "costume": player.costume}
+
+        if args.sync:
+            body = dict(position, events=outgoing, version=player.version, cursor=player.cursor)
+            if body["version"] is None:
+                del body["version"]
+            response = self.request(session, "POST /rooms/<id>/sync", "POST", room + "/sync", json=body)
+            if response is not None:
+                data = response.json()["data"]
+                player.version = data["version"] if "version" in data else player.version
+                player.cursor = data["cursor"] if "cursor" in data else player.cursor
+        else:
+            self.request(session, "POST /rooms/<id>/users", "POST", room + "/users", json=position)
+
+            params = {"since": player.version} if player.version is not None else None
+            response = self.request(session, "GET /rooms/<id>/users", "GET", room + "/users", params=params)
+            if response is not None and response.status_code == 200:
+                body = response.json()
+                player.version = body["version"] if "version" in body else player.version
+
+            for event in outgoing:
+                self.request(session, "POST /rooms/<id>/events/post", "POST", room + "/events/post",
+                    json={"username": player.username, "type": event["type"], "data": event["data"]})
+
+            body = {"username": player.username}
+            if player.cursor is not None:
+                body["since"] = player.cursor
+            response = self.request(session, "POST /rooms/<id>/events/get", "POST", room + "/events/get", json=body)
+            if response is not None:
+                player.cursor = response.json()["data"]["cursor"]
+
+        if random.random() < args.save_chance:
+            headers = {"If-None-Match": player.save_etag} if player.save_etag is not None else None
+            response = self.request(session, "POST /saves/get", "POST", "/saves/get", json={"username": player.username}, headers=headers)
+            if response is not None and response.headers.get("ETag") is not None:
+                player.save_etag = response.headers["ETag"]
+
+            if random.random() < 0.5:
+                save = json.dumps({"presents": random.randint(0, 30), "step": player.steps})
+                self.request(session, "POST /saves/post", "POST", "/saves/post", json={"username": player.username, "data": save})
+
+    # each worker owns a slice of the players and steps whichever is due next
+    def worker(self, players):
+        session = requests.Session()
+        interval = self.args.tick_ms / 1000
+        while not self.stop.is_set():
+            player = min(players, key=lambda p: p.next_step)
+            delay = player.next_step - time.perf_counter()
+            if delay > 0:
+                if self.stop.wait(delay):
+                    break
+            self.step(session, player)
+            player.next_step = max(player.next_step + interval, time.perf_counter())
+
+    def run(self) -> float:
+        players = [Player(i, self.args) for i in range(self.args.players)]
+        workers = min(self.args.workers, len(players))
+        threads = [
+            threading.Thread(target=self.worker, args=(players[i::workers],), daemon=True)
+            for i in range(workers)
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        self.stop.wait(self.args.duration)
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+class RssMonitor:
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def read_kb(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def run(self):
+        while not self.stop.wait(0.5):
+            kb = self.read_kb()
+            if kb is not None:
+                self.samples.append(kb)
+
+    def summary(self) -> dict:
+        if len(self.samples) == 0:
+            return {}
+        return {"start_kb": self.samples[0], "end_kb": self.samples[-1], "peak_kb": max(self.samples)}
+
+
+def start_server(port):
+    # a scratch copy, so the benchmark never touches the real data folder
+    workdir = tempfile.mkdtemp(prefix="tankmas-bench-")
+    shutil.copytree(legacy_dir, workdir, dirs_exist_ok=True, ignore=shutil.ignore_patterns("data", "bench", "cert", "__pycache__", "*.db*"))
+
+    env = dict(os.environ, SERVER_PORT=str(port))
+    process = subprocess.Popen([sys.executable, "server.py"], cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode}")
+        try:
+            requests.get(url + "/", timeout=1)
+            return process, workdir, url
+        except requests.RequestException:
+            time.sleep(0.2)
+
+    process.kill()
+    raise RuntimeError("server did not come up")
+
+
+def get_server_stats(url):
+    try:
+        return requests.get(url + "/log/stats", timeout=10).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+# share of handler time spent inside SQLite between two /log/stats snapshots
+def db_share(before, after) -> dict:
+    if before is None or after is None:
+        return {}
+    request_ms = after["load"]["request_ms"] - before["load"]["request_ms"]
+    request_db = after["connections"]["request_db_seconds"] - before["connections"]["request_db_seconds"]
+    background_db = after["connections"]["background_db_seconds"] - before["connections"]["background_db_seconds"]
+    return {
+        "request_ms": request_ms,
+        "request_db_ms": request_db * 1000,
+        "background_db_ms": background_db * 1000,
+        "statements": after["connections"]["statements"] - before["connections"]["statements"],
+        "share": request_db * 1000 / request_ms if request_ms > 0 else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=legacy_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline = None):
+    print(f"\n{results['players']} players, {results['elapsed']:.1f}s, {results['rps']:.1f} req/s")
+    print(f"  {'route':32}{'count':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for route, r in sorted(results["routes"].items()):
+        line = f"  {route:32}{r['count']:8d}{r['errors']:6d}{r['rps']:9.1f}{r['p50_ms']:9.2f}{r['p95_ms']:9.2f}{r['p99_ms']:9.2f}"
+        if baseline is not None and route in baseline["routes"]:
+            old = baseline["routes"][route]["p95_ms"]
+            if old > 0:
+                line += f"  p95 {(r['p95_ms'] - old) / old * 100:+.1f}%"
+        print(line)
+
+    db = results["db"]
+    if "share" in db:
+        print(f"  db share of request time {db['share'] * 100:.1f}%, background db {db['background_db_ms']:.0f}ms, {db['statements']} statements")
+    rss = results["rss"]
+    if "peak_kb" in rss:
+        print(f"  rss start {rss['start_kb'] / 1024:.1f}MB, end {rss['end_kb'] / 1024:.1f}MB, peak {rss['peak_kb'] / 1024:.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load after warmup")
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--workers", type=int, default=32, help="client threads, players are spread over them")
+    parser.add_argument("--tick-ms", type=float, default=500, help="time between two steps of one player")
+    parser.add_argument("--room", type=int, default=1)
+    parser.add_argument("--sync", action="store_true", help="use /sync instead of separate update, poll and event requests")
+    parser.add_argument("--event-chance", type=float, default=0.1)
+    parser.add_argument("--save-chance", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--url", help="use a running server instead of starting one")
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--out", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    process = None
+    workdir = None
+    url = args.url
+    if url is None:
+        process, workdir, url = start_server(args.port)
+
+    monitor = RssMonitor(process.pid) if process is not None else None
+    if monitor is not None:
+        monitor.thread.start()
+
+    try:
+        if args.warmup > 0:
+            LoadTest(argparse.Namespace(**dict(vars(args), duration=args.warmup)), url).run()
+
+        before = get_server_stats(url)
+        test = LoadTest(args, url)
+        elapsed = test.run()
+        after = get_server_stats(url)
+    finally:
+        if monitor is not None:
+            monitor.stop.set()
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    routes = test.stats.summary(elapsed)
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "args": vars(args),
+        "players": args.players,
+        "elapsed": elapsed,
+        "rps": sum(r["count"] for r in routes.values()) / elapsed,
+        "routes": routes,
+        "db": db_share(before, after),
+        "rss": monitor.summary() if monitor is not None else {},
+        "server": after,
+    }
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    if args.out is not None:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
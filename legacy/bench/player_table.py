@@ -0,0 +1,88 @@
+# Memory per player and the cost of the per-room sweeps in RoomState, the
+# in-process user table every room poll reads from.
+#
+#   python3 bench/player_table.py --players 10000 --rooms 1 --rounds 20
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from db.room_state import RoomState
+
+costumes = ["tankman", "paco", "santa", "elf", "snowman", "reindeer"]
+maps = ["intro", "lobby", "roof"]
+
+
+def time_it(fn, rounds) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def populate(state, players, rooms):
+    for i in range(players):
+        state.upsert_user(
+            f"player_{i:05d}",
+            i % rooms + 1,
+            random.uniform(0, 4000),
+            random.uniform(0, 2400),
+            random.choice([-1, 1]),
+            # costumes arrive as fresh strings off the JSON body, not shared literals
+            "".join(random.choice(costumes)),
+            {},
+            "".join(random.choice(maps)),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--radius", type=float, default=600)
+    args = parser.parse_args()
+
+    random.seed(1)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = RoomState(600)
+    populate(state, args.players, args.rooms)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # the table as the flush sees it; these rows are written, not kept
+    state.take_dirty()
+
+    room_users = args.players // args.rooms
+    print(f"{args.players} players in {args.rooms} room(s), {room_users} per room")
+    print(f"memory: {(after - before) / args.players:.0f} bytes per player ({(after - before) / 1024 / 1024:.1f} MiB)")
+
+    version = state.get_version(1)
+    # 1% of the room moves between polls
+    for i in range(0, room_users, 100):
+        state.upsert_user(f"player_{i * args.rooms:05d}", 1, random.uniform(0, 4000), random.uniform(0, 2400))
+
+    view = {"map": maps[0], "x": 2000, "y": 1200, "radius": args.radius}
+    results = {
+        "get_users": time_it(lambda: state.get_users(1), args.rounds),
+        "get_changes full": time_it(lambda: state.get_changes(1, -1), args.rounds),
+        "get_changes delta": time_it(lambda: state.get_changes(1, version), args.rounds),
+        "get_changes view": time_it(lambda: state.get_changes(1, -1, view=view), args.rounds),
+        "get_users view": time_it(lambda: state.get_users(1, view), args.rounds),
+        "expire_idle": time_it(state.expire_idle, args.rounds),
+        "heartbeat upsert": time_it(lambda: state.upsert_user("player_00000", 1), args.rounds) * 1000,
+    }
+
+    for name, ms in results.items():
+        unit = "us" if name == "heartbeat upsert" else "ms"
+        print(f"{name:>20}: {ms:8.3f} {unit}")
+
+
+if __name__ == "__main__":
+    main()
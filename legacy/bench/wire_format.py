@@ -0,0 +1,112 @@
+# Size and speed of the binary room format against the JSON path.
+#
+#   python3 bench/wire_format.py --users 100 --rounds 200
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import wire
+
+costumes = ["tankman", "paco", "santa", "elf", "snowman", "reindeer"]
+
+
+def make_users(count, version, moved_fraction):
+    users = {}
+    for i in range(count):
+        username = f"player_{i:05d}"
+        moved = random.random() < moved_fraction
+        users[username] = {
+            "username": username,
+            "x": random.uniform(0, 2000),
+            "y": random.uniform(0, 1200),
+            "costume": random.choice(costumes),
+            "sx": random.choice([-1, 1]),
+            "data": {},
+            "timestamp": time.time(),
+            "online": True,
+            "field_versions": {
+                "x": version if moved else 1,
+                "y": version if moved else 1,
+                "sx": 1,
+                "costume": 1,
+                "data": 1,
+            },
+        }
+    return users
+
+
+def strip_versions(users):
+    return {u: {k: v for k, v in user.items() if k != "field_versions"} for u, user in users.items()}
+
+
+def time_it(fn, rounds) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000000
+
+
+def compare(label, users, full, since, rounds):
+    json_users = strip_versions(users)
+    package = {"tick_rate": 500, "data": json_users, "removed": [], "version": 2, "full": full}
+
+    json_body = json.dumps(package, separators=(",", ":")).encode()
+    wire_body = wire.encode_room(users, [], 2, 500, full, since)
+
+    decoded = wire.decode_room(wire_body)
+    assert set(decoded["users"]) == set(users)
+
+    results = {
+        "json_bytes": len(json_body),
+        "wire_bytes": len(wire_body),
+        "json_gzip_bytes": len(gzip.compress(json_body)),
+        "wire_gzip_bytes": len(gzip.compress(wire_body)),
+        "json_encode_us": time_it(lambda: json.dumps(package, separators=(",", ":")).encode(), rounds),
+        "wire_encode_us": time_it(lambda: wire.encode_room(users, [], 2, 500, full, since), rounds),
+        "json_decode_us": time_it(lambda: json.loads(json_body), rounds),
+        "wire_decode_us": time_it(lambda: wire.decode_room(wire_body), rounds),
+    }
+
+    print(f"\n{label}")
+    print(f"  {'':18}{'json':>12}{'wire':>12}{'ratio':>8}")
+    for name in ["bytes", "gzip_bytes", "encode_us", "decode_us"]:
+        j = results["json_" + name]
+        w = results["wire_" + name]
+        print(f"  {name:18}{j:12.1f}{w:12.1f}{w / j if j else 0:8.2f}")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--moved", type=float, default=0.2, help="fraction of users that moved in the delta")
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--out", help="write the results as JSON")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    users = make_users(args.users, 2, args.moved)
+    moved = {u: user for u, user in users.items() if user["field_versions"]["x"] == 2}
+
+    results = {
+        "users": args.users,
+        "full": compare(f"full snapshot, {args.users} users", users, True, None, args.rounds),
+        "delta": compare(f"delta, {len(moved)} of {args.users} users moved", moved, False, 1, args.rounds),
+    }
+
+    if args.out is not None:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# Online backups through the sqlite3 backup API. The copy runs on its own thread
+# a few pages at a time, sleeping between steps so game writes keep flowing, and
+# always produces a consistent snapshot even mid-transaction.
+
+backup_suffix = "-backup.db"
+
+
+class BackupManager:
+    def __init__(self, connect, backup_dir, pages_per_step = 256, step_sleep_ms = 10, keep_last = 10, keep_daily = 7, compress = False):
+        self.connect = connect
+        self.backup_dir = backup_dir
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep_ms / 1000
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.compress = compress
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.completed = 0
+        self.failed = 0
+        self.last_file = None
+        self.last_duration = 0
+        self.last_copy_duration = 0
+        self.last_size = 0
+        self.last_pages = 0
+        self.last_finished = None
+        self.progress_remaining = 0
+        self.progress_total = 0
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    # kicks off a backup in the background; returns False if one is still going
+    def start(self) -> bool:
+        with self.lock:
+            if self.running():
+                return False
+            self.thread = threading.Thread(target=self.run, name="backup", daemon=True)
+            self.thread.start()
+            return True
+
+    def wait(self, timeout = None):
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def progress(self, status, remaining, total):
+        self.progress_remaining = remaining
+        self.progress_total = total
+        # yield to live traffic between steps
+        if self.step_sleep > 0:
+            time.sleep(self.step_sleep)
+
+    def run(self):
+        Path(self.backup_dir).mkdir(parents=True, exist_ok=True)
+        backup_name = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S") + backup_suffix
+        backup_path = f"{self.backup_dir}/{backup_name}"
+        partial_path = backup_path + ".partial"
+
+        start = time.perf_counter()
+        try:
+            src = self.connect()
+            dst = sqlite3.connect(partial_path)
+            try:
+                # pin a WAL read snapshot for the whole copy, otherwise every write from
+                # another connection between steps makes sqlite restart the backup
+                src.execute("BEGIN")
+                src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+                src.backup(dst, pages=self.pages_per_step, progress=self.progress)
+            finally:
+                dst.close()
+                src.close()
+            copy_duration = time.perf_counter() - start
+
+            if self.compress:
+                with open(partial_path, "rb") as f_in, gzip.open(partial_path + ".gz", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(partial_path)
+                partial_path = partial_path + ".gz"
+                backup_path = backup_path + ".gz"
+
+            os.replace(partial_path, backup_path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"BACKUP ERROR @ {backup_path}: {e}")
+            if os.path.isfile(partial_path):
+                os.remove(partial_path)
+            with self.lock:
+                self.failed += 1
+            return
+
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.completed += 1
+            self.last_file = backup_path
+            self.last_duration = duration
+            self.last_copy_duration = copy_duration
+            self.last_size = os.path.getsize(backup_path)
+            self.last_pages = self.progress_total
+            self.last_finished = time.time()
+
+        self.prune()
+
+    # keeps the newest keep_last backups plus the newest one of each of the last keep_daily days
+    def prune(self):
+        backups = sorted(
+            f for f in os.listdir(self.backup_dir)
+            if f.endswith(backup_suffix) or f.endswith(backup_suffix + ".gz")
+        )
+        backups.reverse()
+
+        keep = set(backups[:self.keep_last])
+        days = []
+        for name in backups:
+            day = name[:10]
+            if day not in days:
+                days.append(day)
+                if len(days) > self.keep_daily:
+                    break
+                keep.add(name)
+
+        for name in backups:
+            if name not in keep:
+                try:
+                    os.remove(f"{self.backup_dir}/{name}")
+                except OSError as e:
+                    print(f"BACKUP PRUNE ERROR @ {name}: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "running": self.running(),
+                "progress_remaining": self.progress_remaining if self.running() else 0,
+                "progress_total": self.progress_total if self.running() else 0,
+                "completed": self.completed,
+                "failed": self.failed,
+                "last_file": self.last_file,
+                "last_duration": self.last_duration,
+                "last_copy_duration": self.last_copy_duration,
+                "last_size": self.last_size,
+                "last_pages": self.last_pages,
+                "last_finished": self.last_finished,
+            }
@@ -0,0 +1,44 @@
+import threading
+import time
+
+# Wakes long-pollers when a room changes. RoomState and EventRing call notify()
+# with the room id whenever its version or events advance. Threads block in
+# wait(); other event loops (asgi.py) register a listener instead.
+#
+# Waiters re-check their own condition after every wake up, so notify() never
+# needs the caller's locks and can't deadlock against them.
+
+
+class ChangeNotifier:
+    def __init__(self):
+        self.condition = threading.Condition()
+        # room id -> number of changes so far
+        self.generations = {}
+        # callables taking the room id; must be quick and must not block
+        self.listeners = []
+
+    def notify(self, key):
+        with self.condition:
+            self.generations[key] = self.generations.get(key, 0) + 1
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener(key)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # blocks until check() is true or timeout seconds pass; returns check()'s last answer
+    def wait(self, key, check, timeout) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.condition:
+                generation = self.generations.get(key, 0)
+            if check():
+                return True
+
+            with self.condition:
+                while self.generations.get(key, 0) == generation:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import time
+
+# Long-lived SQLite connections. Request handlers borrow one for the lifetime of
+# their app context and hand it back on teardown; background threads (user flush,
+# event writer) keep a dedicated connection from connect().
+#
+# Every connection runs in WAL mode so readers never block the game writers, and
+# keeps a statement cache so the fixed queries are only prepared once.
+#
+# Time spent inside SQLite (execute, fetch, commit) is added up per connection
+# kind, so the share of request time that goes to the database can be measured.
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.connection.add_time(start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.connection.add_time(start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.connection.add_time(start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.add_time(start)
+
+
+class TimedConnection(sqlite3.Connection):
+    # set by the pool: the owning pool, and whether a request or a background thread uses it
+    pool = None
+    background = True
+
+    def add_time(self, start):
+        if self.pool is not None:
+            self.pool.add_time(self.background, time.perf_counter() - start)
+
+    def cursor(self, factory = TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.add_time(start)
+
+
+class ConnectionPool:
+    def __init__(self, database, size = 8, cached_statements = 64, synchronous = "NORMAL", cache_size_kb = 20000, mmap_size = 268435456, busy_timeout_ms = 5000):
+        self.database = database
+        self.size = size
+        self.cached_statements = cached_statements
+        self.pragmas = [
+            "PRAGMA journal_mode=WAL",
+            f"PRAGMA synchronous={synchronous}",
+            f"PRAGMA cache_size=-{int(cache_size_kb)}",
+            f"PRAGMA mmap_size={int(mmap_size)}",
+            f"PRAGMA busy_timeout={int(busy_timeout_ms)}",
+            "PRAGMA temp_store=MEMORY",
+        ]
+
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.request_seconds = 0.0
+        self.background_seconds = 0.0
+        self.statements = 0
+
+    def add_time(self, background, seconds):
+        with self.lock:
+            self.statements += 1
+            if background:
+                self.background_seconds += seconds
+            else:
+                self.request_seconds += seconds
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.database, check_same_thread=False, cached_statements=self.cached_statements, factory=TimedConnection)
+        for pragma in self.pragmas:
+            db.execute(pragma)
+        db.pool = self
+        with self.lock:
+            self.created += 1
+        return db
+
+    def acquire(self) -> sqlite3.Connection:
+        with self.lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            if len(self.idle) > 0:
+                self.reused += 1
+                return self.idle.pop()
+
+        db = self.connect()
+        db.background = False
+        return db
+
+    def release(self, db):
+        # never hand out a connection with a half-finished transaction
+        if db.in_transaction:
+            db.rollback()
+
+        with self.lock:
+            self.in_use -= 1
+            if len(self.idle) < self.size:
+                self.idle.append(db)
+                return
+            self.closed += 1
+
+        db.close()
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+            self.closed += len(idle)
+
+        for db in idle:
+            db.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "created": self.created,
+                "reused": self.reused,
+                "closed": self.closed,
+                "statements": self.statements,
+                "request_db_seconds": self.request_seconds,
+                "background_db_seconds": self.background_seconds,
+            }
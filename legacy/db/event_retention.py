@@ -0,0 +1,139 @@
+import sqlite3
+import time
+
+# Keeps the hot events table small. Each step moves a few small batches into
+# events_archive, every batch in its own short transaction so the event writer
+# never waits long:
+#
+#   - events older than retention_age
+#   - events older than compact_age that a newer event with the same
+#     (username, type) supersedes, so only the latest value stays hot, like the
+#     old EventManager's last-write-wins
+#
+# Nothing is thrown away; the archive keeps the full history.
+
+# a plain INSERT: an id already in the archive fails the batch instead of
+# deleting the hot row unarchived
+MOVE_TO_ARCHIVE = """
+INSERT INTO events_archive(id, room_id, timestamp, username, type, data, archived_at)
+SELECT id, room_id, timestamp, username, type, data, ? FROM events
+WHERE id IN ({ids})
+"""
+
+DELETE_EVENTS = """
+DELETE FROM events WHERE id IN ({ids})
+"""
+
+SELECT_EXPIRED = """
+SELECT id FROM events
+WHERE timestamp < ?
+ORDER BY timestamp
+LIMIT ?
+"""
+
+SELECT_LAST_COMPACTABLE = """
+SELECT MAX(id) FROM events
+WHERE timestamp < ?
+"""
+
+SELECT_SUPERSEDED = """
+SELECT e.id FROM events e
+WHERE e.id > ? AND e.id <= ?
+    AND EXISTS (
+        SELECT 1 FROM events n
+        WHERE n.username = e.username AND n.type = e.type AND n.id > e.id
+    )
+"""
+
+
+class EventRetention:
+    def __init__(self, connect, retention_age = 30 * 24 * 3600, compact_age = 3600, batch_size = 500, budget_ms = 50):
+        self.connect = connect
+        self.db = None
+        self.retention_age = retention_age
+        self.compact_age = compact_age
+        self.batch_size = batch_size
+        self.budget = budget_ms / 1000
+
+        # ids at or below this have been checked for superseded events
+        self.compacted_until = None
+
+        self.archived = 0
+        self.compacted = 0
+        self.last_step_ms = 0
+
+    def get_db(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = self.connect()
+        return self.db
+
+    def move(self, ids) -> int:
+        if len(ids) == 0:
+            return 0
+        placeholders = ",".join("?" * len(ids))
+        db = self.get_db()
+        with db:
+            db.execute(MOVE_TO_ARCHIVE.format(ids=placeholders), [time.time()] + ids)
+            db.execute(DELETE_EVENTS.format(ids=placeholders), ids)
+        return len(ids)
+
+    # one batch of events past the retention age; returns how many moved
+    def archive_batch(self) -> int:
+        if self.retention_age is None:
+            return 0
+        cutoff = time.time() - self.retention_age
+        ids = [row[0] for row in self.get_db().execute(SELECT_EXPIRED, (cutoff, self.batch_size))]
+        moved = self.move(ids)
+        self.archived += moved
+        return moved
+
+    # checks the next window of ids old enough to compact; returns False once it
+    # has caught up
+    def compact_batch(self) -> bool:
+        if self.compact_age is None:
+            return False
+        db = self.get_db()
+        last = db.execute(SELECT_LAST_COMPACTABLE, (time.time() - self.compact_age,)).fetchone()[0]
+        if last is None:
+            return False
+
+        if self.compacted_until is None:
+            first = db.execute("SELECT MIN(id) FROM events").fetchone()[0]
+            self.compacted_until = first - 1
+
+        if self.compacted_until >= last:
+            return False
+
+        window_end = min(last, self.compacted_until + self.batch_size)
+        ids = [row[0] for row in db.execute(SELECT_SUPERSEDED, (self.compacted_until, window_end))]
+        self.compacted += self.move(ids)
+        self.compacted_until = window_end
+        return window_end < last
+
+    # runs batches until there is nothing left to do or the time budget is spent
+    def step(self):
+        start = time.perf_counter()
+        deadline = start + self.budget
+        try:
+            while time.perf_counter() < deadline:
+                if self.archive_batch() < self.batch_size:
+                    break
+            while time.perf_counter() < deadline:
+                if not self.compact_batch():
+                    break
+        except sqlite3.Error as e:
+            print(f"EVENT RETENTION ERROR: {e}")
+        self.last_step_ms = (time.perf_counter() - start) * 1000
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def stats(self) -> dict:
+        return {
+            "archived": self.archived,
+            "compacted": self.compacted,
+            "compacted_until": self.compacted_until,
+            "last_step_ms": self.last_step_ms,
+        }
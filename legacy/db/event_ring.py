@@ -0,0 +1,120 @@
+import threading
+from collections import deque
+
+# Recent events per room, addressed by a global sequence number that doubles as
+# the events.id they are written with. Pollers pass the last sequence they saw.
+#
+# With several worker processes SQLite hands out the ids instead, and each worker
+# fills its ring by tailing the events table with extend().
+#
+# An event only leaves the ring once the event writer has committed it, so a
+# poller that falls behind the ring can always read what it missed from SQLite.
+# While the writer is stalled the ring grows past its size, bounded by the
+# writer's queue.
+
+
+class EventRing:
+    # notify, when given, is called with the room id of every new event
+    def __init__(self, size = 256, notify = None):
+        self.lock = threading.Lock()
+        self.notify = notify
+        self.size = size
+        self.last_seq = 0
+        # room_id -> deque of events, oldest first
+        self.rooms = {}
+        # room_id -> highest sequence that is no longer in that room's ring
+        self.evicted = {}
+        # sequences at or below this were written before the ring existed
+        self.base_seq = 0
+        # sequences handed out by append() that the writer hasn't committed yet
+        self.uncommitted = set()
+
+    def reset(self, last_seq):
+        with self.lock:
+            self.last_seq = last_seq
+            self.base_seq = last_seq
+            self.rooms = {}
+            self.evicted = {}
+            self.uncommitted = set()
+
+    def append(self, room_id, event) -> dict:
+        with self.lock:
+            self.last_seq += 1
+            event["id"] = self.last_seq
+            self.uncommitted.add(event["id"])
+
+            ring = self.rooms.get(room_id)
+            if ring is None:
+                ring = self.rooms[room_id] = deque()
+            ring.append(event)
+            self.trim(room_id, ring)
+
+        if self.notify is not None:
+            self.notify(room_id)
+        return event
+
+    # adds events that already have an id, in id order, e.g. ones another worker
+    # process wrote; anything at or below the current sequence is skipped
+    def extend(self, events):
+        rooms = set()
+        with self.lock:
+            for event in events:
+                if event["id"] <= self.last_seq:
+                    continue
+                self.last_seq = event["id"]
+
+                ring = self.rooms.get(event["room_id"])
+                if ring is None:
+                    ring = self.rooms[event["room_id"]] = deque()
+                ring.append(event)
+                self.trim(event["room_id"], ring)
+                rooms.add(event["room_id"])
+
+        if self.notify is not None:
+            for room_id in rooms:
+                self.notify(room_id)
+
+    # caller holds the lock; drops the oldest events over the size, stopping at
+    # the first one that isn't committed yet
+    def trim(self, room_id, ring):
+        while len(ring) > self.size and ring[0]["id"] not in self.uncommitted:
+            self.evicted[room_id] = ring.popleft()["id"]
+
+    # called by the event writer once a batch of rows (id, ..., room_id) is done
+    def committed(self, rows):
+        with self.lock:
+            rooms = set()
+            for row in rows:
+                if row[0] in self.uncommitted:
+                    self.uncommitted.discard(row[0])
+                    rooms.add(row[5])
+            for room_id in rooms:
+                ring = self.rooms.get(room_id)
+                if ring is not None:
+                    self.trim(room_id, ring)
+
+    # id of the newest event the ring holds for the room, 0 when there is none
+    def latest(self, room_id) -> int:
+        with self.lock:
+            ring = self.rooms.get(room_id)
+            return ring[-1]["id"] if ring else 0
+
+    def current(self) -> int:
+        with self.lock:
+            return self.last_seq
+
+    # returns (events newer than cursor, sequence below which the ring has nothing)
+    def since(self, room_id, cursor):
+        with self.lock:
+            horizon = self.evicted.get(room_id, self.base_seq)
+
+            events = []
+            ring = self.rooms.get(room_id)
+            if ring is not None:
+                for event in reversed(ring):
+                    if event["id"] <= cursor:
+                        break
+                    events.append(event)
+                events.reverse()
+
+            return events, horizon
@@ -0,0 +1,168 @@
+import queue
+import sqlite3
+import threading
+import time
+
+# Group commit for the events table. post() only appends to a bounded queue; a
+# single writer thread drains it and commits a whole batch in one transaction.
+# The writer's connection runs with synchronous=FULL, so a committed batch has
+# been synced to disk even while the rest of the pool runs NORMAL, and a batch
+# that fails (usually a lock held too long) is retried before it is given up on.
+
+INSERT_EVENT = """
+INSERT INTO events(id, timestamp, username, type, data, room_id) VALUES(?, ?, ?, ?, ?, ?)
+"""
+
+
+class EventQueueFull(Exception):
+    pass
+
+
+class EventWrite:
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.error = None
+
+    # blocks until the batch holding this event has been committed and synced
+    def wait(self, timeout = None) -> bool:
+        return self.done.wait(timeout) and self.error is None
+
+
+class EventWriter:
+    # on_commit, when given, is called with the rows of every batch once it is done
+    def __init__(self, connect, max_queue = 4096, batch_size = 256, interval_ms = 20, put_timeout = 0.5, on_commit = None, max_retries = 5, retry_delay_ms = 50):
+        self.connect = connect
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay_ms / 1000
+        self.on_commit = on_commit
+        self.queue = queue.Queue()
+        self.max_queue = max_queue
+        # one slot per queued event; released once its batch is committed
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.put_timeout = put_timeout
+
+        self.stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.committed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.retries = 0
+        self.commits = 0
+        self.last_commit_ms = 0
+        self.max_commit_ms = 0
+        self.total_commit_ms = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="event-writer", daemon=True)
+        self.thread.start()
+
+    # backpressure: a full queue blocks the caller for a bit, then gives up
+    def reserve(self):
+        if not self.slots.acquire(timeout=self.put_timeout):
+            with self.stats_lock:
+                self.rejected += 1
+            raise EventQueueFull()
+
+    # the caller must hold a slot from reserve()
+    def post(self, row) -> EventWrite:
+        write = EventWrite(row)
+        self.queue.put(write)
+
+        with self.stats_lock:
+            self.enqueued += 1
+        return write
+
+    def next_batch(self) -> list:
+        try:
+            first = self.queue.get(timeout=0.25)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    # a failed transaction is rolled back whole, so the batch can simply be run again
+    def write_batch(self, db, batch):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                with db:
+                    db.executemany(INSERT_EVENT, [w.row for w in batch])
+                return None
+            except sqlite3.OperationalError as e:
+                print(f"EVENT COMMIT ERROR (attempt {attempt + 1}): {e}")
+                error = e
+            except sqlite3.Error as e:
+                # constraint errors and the like fail the same way every time
+                print(f"EVENT COMMIT ERROR: {e}")
+                return e
+            if attempt < self.max_retries:
+                with self.stats_lock:
+                    self.retries += 1
+                time.sleep(delay)
+                delay *= 2
+        return error
+
+    def commit(self, db, batch):
+        start = time.perf_counter()
+        error = self.write_batch(db, batch)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self.stats_lock:
+            if error is None:
+                self.committed += len(batch)
+                self.commits += 1
+                self.last_commit_ms = elapsed_ms
+                self.max_commit_ms = max(self.max_commit_ms, elapsed_ms)
+                self.total_commit_ms += elapsed_ms
+            else:
+                self.failed += len(batch)
+
+        if self.on_commit is not None:
+            self.on_commit([w.row for w in batch])
+
+        for w in batch:
+            w.error = error
+            w.done.set()
+            self.slots.release()
+
+    def run(self):
+        db = self.connect()
+        db.execute("PRAGMA synchronous=FULL")
+        while self.running or not self.queue.empty():
+            batch = self.next_batch()
+            if len(batch) > 0:
+                self.commit(db, batch)
+        db.close()
+
+    def stop(self, timeout = 5):
+        self.running = False
+        self.thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "queue_capacity": self.max_queue,
+                "enqueued": self.enqueued,
+                "committed": self.committed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "retries": self.retries,
+                "commits": self.commits,
+                "last_commit_ms": self.last_commit_ms,
+                "max_commit_ms": self.max_commit_ms,
+                "avg_commit_ms": self.total_commit_ms / self.commits if self.commits > 0 else 0,
+            }
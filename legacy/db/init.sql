@@ -10,6 +10,7 @@ CREATE TABLE IF NOT EXISTS users (
 	room_id INTEGER,
 	session_id TEXT,
 	username TEXT NOT NULL UNIQUE,
+	map TEXT,
 	costume TEXT,
 	x INT,
 	y INT,
@@ -31,6 +32,46 @@ CREATE TABLE IF NOT EXISTS saves (
 	id INTEGER PRIMARY KEY AUTOINCREMENT,
 	username TEXT UNIQUE NOT NULL,
 	data text default '',
-	save_time INTEGER DEFAULT CURRENT_TIMESTAMP
-)
+	save_time INTEGER DEFAULT CURRENT_TIMESTAMP,
+	hash TEXT,
+	data_z BLOB
+);
+
+CREATE INDEX IF NOT EXISTS events_room_id_id ON events(room_id, id);
+CREATE INDEX IF NOT EXISTS events_timestamp ON events(timestamp);
+CREATE INDEX IF NOT EXISTS events_username_type_id ON events(username, type, id);
+
+-- events moved out of the hot table by db/event_retention.py
+CREATE TABLE IF NOT EXISTS events_archive (
+	id INTEGER PRIMARY KEY,
+	room_id INTEGER,
+	timestamp INTEGER,
+	username TEXT,
+	type TEXT,
+	data jsonb not null default '{}',
+	archived_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS users_last_timestamp ON users(last_timestamp);
+
+-- coordination between worker processes, see db/shared_state.py
+CREATE TABLE IF NOT EXISTS leases (
+	name TEXT PRIMARY KEY,
+	holder TEXT NOT NULL,
+	expires REAL NOT NULL
+);
 
+CREATE TABLE IF NOT EXISTS event_cursors (
+	username TEXT PRIMARY KEY,
+	cursor INTEGER NOT NULL,
+	last_poll REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS worker_load (
+	worker TEXT NOT NULL,
+	bucket TEXT NOT NULL,
+	rate REAL NOT NULL,
+	p95_ms REAL NOT NULL,
+	updated REAL NOT NULL,
+	PRIMARY KEY (worker, bucket)
+);
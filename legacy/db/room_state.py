@@ -0,0 +1,455 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from tools import TimingWheel
+from db.spatial_index import SpatialGrid
+
+# In-process authoritative copy of the users table. Position updates land here
+# and TankmasDb flushes the dirty users to SQLite in one batched transaction.
+#
+# Every room carries a version that is bumped on each change, and every user
+# remembers the version it last changed at, so pollers can ask for a delta.
+#
+# Updates that repeat what the server already has only refresh the user's
+# timestamp: the room version isn't bumped, so pollers aren't sent the user again,
+# and the row is only written by the slower heartbeat flush.
+#
+# Each room keeps its users ordered by the version they last changed at, so a
+# delta walks back from the newest change and stops at the caller's version
+# instead of visiting the whole room.
+#
+# Positions are also kept in a SpatialGrid so pollers can pass a view (map,
+# position, radius) and only get the users near them. Users further away on the
+# same map are only sent again when they cross into another grid cell.
+
+# removed users remembered per room before old pollers get a full snapshot instead
+max_removed_history = 1024
+
+user_fields = ("username", "room_id", "map", "x", "y", "costume", "sx", "data", "timestamp")
+
+# fields that carry their own last-changed version, so encoders can skip unchanged ones
+versioned_fields = ("map", "x", "y", "sx", "costume", "data")
+
+
+# One user's record. Slots instead of a dict per user, and field versions as a
+# list in versioned_fields order, keep a 10k player table a fraction of the size.
+class Player:
+    __slots__ = user_fields + ("version", "expired", "field_versions")
+
+    def __init__(self, username, room_id, map_name = None, x = None, y = None, costume = None, sx = None, data = None, timestamp = 0, version = 0, expired = True):
+        self.username = username
+        self.room_id = room_id
+        self.map = map_name
+        self.x = x
+        self.y = y
+        self.costume = costume
+        self.sx = sx
+        self.data = data if data is not None else {}
+        self.timestamp = timestamp
+        self.version = version
+        self.expired = expired
+        self.field_versions = [version] * len(versioned_fields)
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in user_fields}
+
+
+# costumes and map names repeat across thousands of players; keep one copy of each
+def intern_name(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class Room:
+    def __init__(self, version, on_change = None):
+        self.on_change = on_change
+        # username -> version it last changed at, oldest first
+        self.users = OrderedDict()
+        # users without a position yet, which every view includes
+        self.unplaced = set()
+        self.version = version
+        # username -> version it left at, oldest first
+        self.removed = OrderedDict()
+        # username -> version it last moved to another map or grid cell at, oldest first
+        self.cell_changes = OrderedDict()
+        # deltas can only be computed for versions at or after this
+        self.horizon = version
+
+    # versions follow the clock so a version handed out by one worker process
+    # means roughly the same moment on the others
+    def bump(self) -> int:
+        self.version = max(self.version + 1, int(time.time() * 1000000))
+        if self.on_change is not None:
+            self.on_change()
+        return self.version
+
+    def add(self, username, version):
+        self.removed.pop(username, None)
+        self.touch(username, version)
+
+    # moves the user to the newest end of the change order
+    def touch(self, username, version):
+        self.users[username] = version
+        self.users.move_to_end(username)
+
+    def remove(self, username):
+        self.users.pop(username, None)
+        self.unplaced.discard(username)
+        self.removed.pop(username, None)
+        self.cell_changes.pop(username, None)
+        self.removed[username] = self.bump()
+        if len(self.removed) > max_removed_history:
+            _, version = self.removed.popitem(last=False)
+            self.horizon = max(self.horizon, version)
+
+    def cell_changed(self, username, version):
+        self.cell_changes.pop(username, None)
+        self.cell_changes[username] = version
+        if len(self.cell_changes) > max_removed_history:
+            _, version = self.cell_changes.popitem(last=False)
+            self.horizon = max(self.horizon, version)
+
+
+class RoomState:
+    # notify, when given, is called with the room id every time a room's version moves
+    def __init__(self, max_idle_time, cell_size = 256, notify = None):
+        self.lock = threading.Lock()
+        self.notify = notify
+        self.max_idle_time = max_idle_time
+        # versions start from the clock so they keep increasing across restarts
+        self.base_version = int(time.time() * 1000000)
+
+        # username -> user record
+        self.users = {}
+        # room_id -> Room
+        self.rooms = {}
+        self.dirty = set()
+        # users whose only change since the last flush is their timestamp
+        self.heartbeats = set()
+        # username -> idle deadline, so expiry only visits users that actually expired
+        self.expiry = TimingWheel()
+        self.grid = SpatialGrid(cell_size)
+
+        self.updates = 0
+        # updates that changed nothing but the timestamp
+        self.unchanged = 0
+        # updates folded into a write that was already pending for the user
+        self.coalesced = 0
+
+    def get_room_entry(self, room_id) -> Room:
+        room = self.rooms.get(room_id)
+        if room is None:
+            on_change = (lambda: self.notify(room_id)) if self.notify is not None else None
+            room = self.rooms[room_id] = Room(self.base_version, on_change)
+        return room
+
+    def load(self, rows):
+        now = time.time()
+        with self.lock:
+            for username, room_id, map_name, x, y, costume, sx, data, timestamp in rows:
+                timestamp = timestamp if timestamp is not None else 0
+                user = self.users[username] = Player(
+                    username, room_id, intern_name(map_name), x, y, intern_name(costume), sx, data, timestamp,
+                    self.base_version, timestamp + self.max_idle_time <= now,
+                )
+                if not user.expired:
+                    room = self.get_room_entry(room_id)
+                    room.add(username, self.base_version)
+                    if x is None or y is None:
+                        room.unplaced.add(username)
+                    self.expiry.touch(username, timestamp + self.max_idle_time)
+                    self.grid.update(username, room_id, map_name, x, y)
+
+    def upsert_user(self, username, room_id, x = None, y = None, sx = None, costume = None, data = None, map_name = None) -> dict:
+        with self.lock:
+            self.updates += 1
+            if username in self.dirty or username in self.heartbeats:
+                self.coalesced += 1
+
+            if self.apply_update(username, room_id, x, y, sx, costume, data, map_name, time.time()):
+                self.dirty.add(username)
+                self.heartbeats.discard(username)
+            else:
+                self.unchanged += 1
+                if username not in self.dirty:
+                    self.heartbeats.add(username)
+            return self.users[username].as_dict()
+
+    # merges rows other workers flushed to the users table; rows that aren't newer
+    # than what this worker has (including its own flushes) are skipped
+    def apply_remote(self, rows) -> int:
+        now = time.time()
+        applied = 0
+        with self.lock:
+            for username, room_id, map_name, x, y, costume, sx, data, timestamp in rows:
+                if timestamp is None or timestamp + self.max_idle_time <= now:
+                    continue
+                user = self.users.get(username)
+                if user is not None and user.timestamp >= timestamp:
+                    continue
+                self.apply_update(username, room_id, x, y, sx, costume, data, map_name, timestamp)
+                applied += 1
+        return applied
+
+    # caller holds the lock; returns False when only the timestamp moved
+    def apply_update(self, username, room_id, x, y, sx, costume, data, map_name, timestamp) -> bool:
+        user = self.users.get(username)
+
+        # a position the grid can't place raises here, before anything changed
+        new_x = x if x is not None else (user.x if user is not None else None)
+        new_y = y if y is not None else (user.y if user is not None else None)
+        if new_x is not None and new_y is not None:
+            self.grid.cell_key(room_id, map_name, new_x, new_y)
+
+        if user is None:
+            user = self.users[username] = Player(username, room_id)
+        elif user.room_id != room_id:
+            if not user.expired:
+                self.get_room_entry(user.room_id).remove(username)
+                self.grid.remove(username)
+            user.expired = True
+            user.room_id = room_id
+
+        # same order as versioned_fields
+        values = (intern_name(map_name), x, y, sx, intern_name(costume), data)
+        changes = [
+            (i, value)
+            for i, value in enumerate(values)
+            if value is not None and getattr(user, versioned_fields[i]) != value
+        ]
+
+        # a heartbeat: nothing for pollers, only the idle deadline moves
+        if not user.expired and len(changes) == 0:
+            user.timestamp = timestamp
+            self.expiry.touch(username, timestamp + self.max_idle_time)
+            return False
+
+        room = self.get_room_entry(room_id)
+        version = room.bump()
+        field_versions = user.field_versions
+
+        # anyone who saw this user before they left has forgotten them
+        if user.expired:
+            room.add(username, version)
+            user.expired = False
+            for i in range(len(field_versions)):
+                field_versions[i] = version
+        else:
+            room.touch(username, version)
+
+        for i, value in changes:
+            setattr(user, versioned_fields[i], value)
+            field_versions[i] = version
+
+        if user.x is None or user.y is None:
+            room.unplaced.add(username)
+        else:
+            room.unplaced.discard(username)
+
+        if self.grid.update(username, room_id, user.map, user.x, user.y):
+            room.cell_changed(username, version)
+
+        user.timestamp = timestamp
+        user.version = version
+        self.expiry.touch(username, timestamp + self.max_idle_time)
+
+        return True
+
+    def get_user(self, username):
+        with self.lock:
+            user = self.users.get(username)
+            if user is None:
+                return None
+            return user.as_dict()
+
+    def format_user(self, user, now, field_versions = False) -> dict:
+        formatted = {
+            "username": user.username,
+            "map": user.map,
+            "x": user.x,
+            "y": user.y,
+            "costume": user.costume,
+            "sx": user.sx,
+            "data": user.data,
+            "timestamp": user.timestamp,
+            "online": user.timestamp + self.max_idle_time > now,
+        }
+        if field_versions:
+            formatted["field_versions"] = dict(zip(versioned_fields, user.field_versions))
+        return formatted
+
+    # usernames in the room that are within the view's radius on the view's map;
+    # users that haven't sent a position yet count as near
+    def near_users(self, room, room_id, view) -> set:
+        cx = view["x"]
+        cy = view["y"]
+        radius_sq = view["radius"] * view["radius"]
+        users = self.users
+        near = {
+            username
+            for username in self.grid.query(room_id, view["map"], cx, cy, view["radius"])
+            if (users[username].x - cx) ** 2 + (users[username].y - cy) ** 2 <= radius_sq
+        }
+        near.update(room.unplaced)
+        return near
+
+    def get_users(self, room_id = None, view = None) -> dict:
+        now = time.time()
+        users = {}
+        with self.lock:
+            if room_id is None:
+                for username, user in self.users.items():
+                    users[username] = self.format_user(user, now)
+                return users
+
+            room = self.rooms.get(room_id)
+            if room is None:
+                return users
+
+            names = room.users if view is None else self.near_users(room, room_id, view)
+            cutoff = now - self.max_idle_time
+            for username in names:
+                user = self.users[username]
+                if user.timestamp > cutoff:
+                    users[username] = self.format_user(user, now)
+
+        return users
+
+    # returns (changed users, removed usernames, version, full). A full snapshot is
+    # sent when the caller's version predates what the room still remembers.
+    #
+    # With a view, only near users are sent on every change. Far users on the same
+    # map are sent when they cross a cell, and users that moved to another map are
+    # reported as removed. Once the viewer moves, users can be near whose latest
+    # state it never got, so then every near user is sent; a view without a
+    # "username" can't tell whether its point moved and always gets them all.
+    def get_changes(self, room_id, since, field_versions = False, view = None) -> tuple:
+        now = time.time()
+        users = {}
+        removed = []
+        with self.lock:
+            room = self.get_room_entry(room_id)
+            full = since < room.horizon or since > room.version
+
+            if view is None:
+                if full:
+                    for username in room.users:
+                        users[username] = self.format_user(self.users[username], now, field_versions)
+                else:
+                    for username, version in reversed(room.users.items()):
+                        if version <= since:
+                            break
+                        users[username] = self.format_user(self.users[username], now, field_versions)
+            else:
+                near = self.near_users(room, room_id, view)
+                viewer = self.users.get(view["username"]) if "username" in view else None
+                # map, x and y are the first three field versions
+                refresh = full or viewer is None or max(viewer.field_versions[:3]) > since
+                for username in near:
+                    user = self.users[username]
+                    if refresh or user.version > since:
+                        users[username] = self.format_user(user, now, field_versions)
+
+                if full:
+                    for username in room.users:
+                        user = self.users[username]
+                        if username not in near and user.map == view["map"]:
+                            users[username] = self.format_user(user, now, field_versions)
+                else:
+                    for username, version in reversed(room.cell_changes.items()):
+                        if version <= since:
+                            break
+                        if username in near:
+                            continue
+                        user = self.users[username]
+                        if user.map == view["map"]:
+                            users[username] = self.format_user(user, now, field_versions)
+                        else:
+                            removed.append(username)
+
+            if not full:
+                for username, version in reversed(room.removed.items()):
+                    if version <= since:
+                        break
+                    removed.append(username)
+
+            return users, removed, room.version, full
+
+    def get_version(self, room_id) -> int:
+        with self.lock:
+            return self.get_room_entry(room_id).version
+
+    # room_id -> number of users currently in it
+    def get_room_sizes(self) -> dict:
+        with self.lock:
+            return {room_id: len(room.users) for room_id, room in self.rooms.items()}
+
+    # takes a user out of room_id right away, for a user who moved to a room another
+    # process owns. Their record is backdated so it reads as idle once flushed, and a
+    # restart doesn't put them back.
+    def remove_user(self, username, room_id) -> bool:
+        with self.lock:
+            user = self.users.get(username)
+            if user is None or user.expired or user.room_id != room_id:
+                return False
+            user.expired = True
+            self.get_room_entry(room_id).remove(username)
+            self.grid.remove(username)
+            self.expiry.discard(username)
+            user.timestamp = min(user.timestamp, time.time() - self.max_idle_time)
+            self.dirty.add(username)
+            self.heartbeats.discard(username)
+            return True
+
+    # drops users that went idle from their room so delta pollers hear about it
+    def expire_idle(self) -> int:
+        with self.lock:
+            expired = self.expiry.expire(time.time())
+            for username in expired:
+                user = self.users[username]
+                if not user.expired:
+                    user.expired = True
+                    self.get_room_entry(user.room_id).remove(username)
+                    self.grid.remove(username)
+        return len(expired)
+
+    # rows to write; users that only sent heartbeats are included when heartbeats is set
+    def take_dirty(self, heartbeats = True) -> list:
+        with self.lock:
+            usernames = self.dirty
+            self.dirty = set()
+            if heartbeats:
+                usernames = usernames | self.heartbeats
+                self.heartbeats = set()
+
+            rows = []
+            for username in usernames:
+                user = self.users[username]
+                rows.append((
+                    username,
+                    user.room_id,
+                    user.map,
+                    user.x,
+                    user.y,
+                    user.sx,
+                    user.costume,
+                    user.data,
+                    user.timestamp,
+                ))
+            return rows
+
+    def mark_dirty(self, usernames):
+        with self.lock:
+            self.dirty.update(usernames)
+            self.heartbeats.difference_update(usernames)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "updates": self.updates,
+                "unchanged": self.unchanged,
+                "coalesced": self.coalesced,
+                "pending_writes": len(self.dirty),
+                "pending_heartbeats": len(self.heartbeats),
+            }
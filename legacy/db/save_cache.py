@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+
+# Size-bounded LRU of recently used saves: username -> (hash, data).
+
+
+class SaveCache:
+    def __init__(self, max_bytes = 16 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(username)
+            self.hits += 1
+            return entry
+
+    def put(self, username, save_hash, data):
+        size = len(data)
+        with self.lock:
+            old = self.entries.pop(username, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[username] = (save_hash, data)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,132 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Coordination between worker processes (gunicorn -w N) that share one SQLite
+# file: a leader lease so only one worker runs backups and cleanup, event cursors
+# for clients that don't track their own, and each worker's recent load so every
+# worker computes the same tick rate. The tables are created by init.sql.
+
+ACQUIRE_LEASE = """
+INSERT INTO leases(name, holder, expires) VALUES(?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires=excluded.expires
+    WHERE leases.holder = excluded.holder OR leases.expires < ?;
+"""
+
+UPSERT_CURSORS = """
+INSERT INTO event_cursors(username, cursor, last_poll) VALUES(?, ?, ?)
+    ON CONFLICT(username) DO UPDATE SET cursor=excluded.cursor, last_poll=excluded.last_poll;
+"""
+
+UPSERT_LOAD = """
+INSERT INTO worker_load(worker, bucket, rate, p95_ms, updated) VALUES(?, ?, ?, ?, ?)
+    ON CONFLICT(worker, bucket) DO UPDATE SET rate=excluded.rate, p95_ms=excluded.p95_ms, updated=excluded.updated;
+"""
+
+SELECT_LOAD = """
+SELECT bucket, SUM(rate), MAX(p95_ms), COUNT(*) FROM worker_load
+WHERE updated > ?
+GROUP BY bucket
+"""
+
+
+class SharedState:
+    def __init__(self, connect, lease_ttl = 10):
+        self.connect = connect
+        self.lease_ttl = lease_ttl
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.Lock()
+        self.db = None
+        self.leader = False
+        self.workers = 1
+
+    def get_db(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = self.connect()
+        return self.db
+
+    # takes or renews the named lease; returns True while this worker holds it
+    def acquire_lease(self, name) -> bool:
+        now = time.time()
+        with self.lock:
+            db = self.get_db()
+            try:
+                with db:
+                    db.execute(ACQUIRE_LEASE, (name, self.worker_id, now + self.lease_ttl, now))
+                row = db.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"LEASE ERROR: {e}")
+                return False
+        return row is not None and row[0] == self.worker_id
+
+    def release_lease(self, name):
+        with self.lock:
+            db = self.get_db()
+            try:
+                with db:
+                    db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, self.worker_id))
+            except sqlite3.Error as e:
+                print(f"LEASE ERROR: {e}")
+
+    def update_leader(self) -> bool:
+        self.leader = self.acquire_lease("leader")
+        return self.leader
+
+    # rows of (username, cursor, last_poll)
+    def put_cursors(self, rows):
+        with self.lock:
+            db = self.get_db()
+            try:
+                with db:
+                    db.executemany(UPSERT_CURSORS, rows)
+            except sqlite3.Error as e:
+                print(f"CURSOR FLUSH ERROR: {e}")
+                return False
+        return True
+
+    def cleanup_cursors(self, cutoff):
+        with self.lock:
+            db = self.get_db()
+            try:
+                with db:
+                    db.execute("DELETE FROM event_cursors WHERE last_poll < ?", (cutoff,))
+            except sqlite3.Error as e:
+                print(f"CURSOR CLEANUP ERROR: {e}")
+
+    # publishes this worker's {bucket: (rate, p95_ms)} and returns the same for all
+    # workers that reported within max_age: rates summed, the worst p95
+    def exchange_load(self, buckets, max_age) -> dict:
+        now = time.time()
+        with self.lock:
+            db = self.get_db()
+            try:
+                with db:
+                    db.executemany(UPSERT_LOAD, [(self.worker_id, key, rate, p95_ms, now) for key, (rate, p95_ms) in buckets.items()])
+                    db.execute("DELETE FROM worker_load WHERE updated < ?", (now - max_age * 10,))
+                rows = db.execute(SELECT_LOAD, (now - max_age,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"LOAD EXCHANGE ERROR: {e}")
+                return buckets
+
+        load = {}
+        for key, rate, p95_ms, _ in rows:
+            load[key] = (rate, p95_ms)
+        # every worker reports the global bucket, so the busiest bucket counts them all
+        if len(rows) > 0:
+            self.workers = max(row[3] for row in rows)
+        return load
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def stats(self) -> dict:
+        return {
+            "worker": self.worker_id,
+            "leader": self.leader,
+            "workers": self.workers,
+        }
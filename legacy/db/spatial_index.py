@@ -0,0 +1,68 @@
+import math
+
+# Uniform grid over every room's maps. Users are bucketed by (room, map, cell) on
+# position upsert so "who is near me" only looks at the cells around the viewer.
+
+
+class SpatialGrid:
+    def __init__(self, cell_size = 256):
+        self.cell_size = cell_size
+        # (room_id, map, cx, cy) -> set of usernames
+        self.cells = {}
+        # username -> cell key
+        self.user_cells = {}
+
+    def cell_key(self, room_id, map_name, x, y) -> tuple:
+        return (room_id, map_name, math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    # returns True when the user ended up in a different cell
+    def update(self, username, room_id, map_name, x, y) -> bool:
+        if x is None or y is None:
+            return self.remove(username)
+
+        key = self.cell_key(room_id, map_name, x, y)
+        old = self.user_cells.get(username)
+        if old == key:
+            return False
+
+        if old is not None:
+            self.discard_from_cell(username, old)
+        self.cells.setdefault(key, set()).add(username)
+        self.user_cells[username] = key
+        return True
+
+    def remove(self, username) -> bool:
+        old = self.user_cells.pop(username, None)
+        if old is None:
+            return False
+        self.discard_from_cell(username, old)
+        return True
+
+    def discard_from_cell(self, username, key):
+        cell = self.cells[key]
+        cell.discard(username)
+        if len(cell) == 0:
+            del self.cells[key]
+
+    # usernames in the cells overlapping the square around (x, y); callers do the
+    # exact distance check
+    def query(self, room_id, map_name, x, y, radius) -> list:
+        min_cx = math.floor((x - radius) / self.cell_size)
+        max_cx = math.floor((x + radius) / self.cell_size)
+        min_cy = math.floor((y - radius) / self.cell_size)
+        max_cy = math.floor((y + radius) / self.cell_size)
+
+        found = []
+        # a huge radius covers more cells than exist, walk the occupied ones instead
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(self.cells):
+            for key, cell in self.cells.items():
+                if key[0] == room_id and key[1] == map_name and min_cx <= key[2] <= max_cx and min_cy <= key[3] <= max_cy:
+                    found.extend(cell)
+            return found
+
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                cell = self.cells.get((room_id, map_name, cx, cy))
+                if cell is not None:
+                    found.extend(cell)
+        return found
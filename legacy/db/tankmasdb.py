@@ -1,39 +1,249 @@
 import sqlite3
-from pathlib import Path
 from flask import g
 import json
 import time
-import shutil
-import datetime
+import threading
+import hashlib
+import os
+import zlib
+from pathlib import Path
+
+from db.room_state import RoomState
+from db.event_writer import EventWriter
+from db.event_ring import EventRing
+from db.connection_pool import ConnectionPool
+from db.backup_manager import BackupManager
+from db.save_cache import SaveCache
+from db.shared_state import SharedState
+from db.event_retention import EventRetention
+from db.change_notifier import ChangeNotifier
 
-DATABASE = 'data/tankmas.db'
+DATA_DIR = 'data'
+DATABASE_FILE = 'tankmas.db'
 INIT_FILE = 'db/init.sql'
 BACKUP_DIR = 'backups'
 
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-    return db
+# the fixed hot-path queries live here so every pooled connection's statement
+# cache sees identical text and only prepares them once
+
+UPSERT_USERS = """
+INSERT INTO users(username, room_id, map, x, y, sx, costume, data, last_timestamp)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(username) DO UPDATE SET
+        room_id=excluded.room_id, map=excluded.map, x=excluded.x, y=excluded.y, sx=excluded.sx,
+        costume=excluded.costume, data=excluded.data,
+        last_timestamp=excluded.last_timestamp
+    WHERE excluded.last_timestamp >= users.last_timestamp;
+"""
+
+# ids are never handed out twice, even after retention has emptied the events
+# table: sqlite_sequence remembers the highest id AUTOINCREMENT ever saw
+SELECT_LAST_EVENT_ID = """
+SELECT MAX(id) FROM (
+    SELECT MAX(id) AS id FROM events
+    UNION ALL SELECT MAX(id) FROM events_archive
+    UNION ALL SELECT seq FROM sqlite_sequence WHERE name = 'events'
+)
+"""
+
+SELECT_USERS = """
+SELECT 
+    u.username, u.room_id, u.map, u.x, u.y, u.costume, u.sx, u.data, 
+    u.last_timestamp
+FROM users u
+"""
+
+SELECT_USERS_UPDATED = SELECT_USERS + """
+WHERE u.last_timestamp > ?
+"""
+
+SELECT_EVENTS_BETWEEN = """
+SELECT id, username, type, room_id, timestamp, data
+FROM events
+WHERE room_id = ? AND id > ? AND id <= ?
+ORDER BY id
+LIMIT ?
+"""
+
+SELECT_EVENTS_AFTER = """
+SELECT id, username, type, room_id, timestamp, data
+FROM events
+WHERE id > ?
+ORDER BY id
+LIMIT ?
+"""
+
+SELECT_EVENT_CURSOR = """
+SELECT cursor, last_poll FROM event_cursors
+WHERE username = ?
+"""
+
+UPSERT_SAVE = """
+INSERT INTO saves(username, data, data_z, hash, save_time) VALUES(?, '', ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(username) DO UPDATE SET
+        data='', data_z=excluded.data_z, hash=excluded.hash, save_time=CURRENT_TIMESTAMP;
+"""
+
+SELECT_SAVE_HASH = """
+SELECT hash FROM saves
+WHERE username = ?
+"""
+
+SELECT_SAVE = """
+SELECT data, data_z, hash FROM saves
+WHERE username = ?
+"""
+
+# columns added to tables created by older versions of init.sql
+MIGRATIONS = {
+    "users": [
+        ("map", "TEXT"),
+    ],
+    "saves": [
+        ("hash", "TEXT"),
+        ("data_z", "BLOB"),
+    ],
+}
+
+# rows per query when streaming dumps; each chunk is its own short read, so a
+# long dump never pins one snapshot or holds more than a chunk in memory
+dump_chunk_size = 500
+
+# a worker flushes users with the time of their last update, not of the flush,
+# so refreshes look back this much further than the flush interval
+user_refresh_overlap = 2
+
+def hash_save(data) -> str:
+    return hashlib.sha1(data.encode()).hexdigest()
+
+# the data column is declared jsonb, which SQLite gives numeric affinity, so a
+# number comes back as a number instead of its JSON text
+def load_event_data(data):
+    return json.loads(data) if isinstance(data, str) else data
+
+def event_from_row(e) -> dict:
+    return {
+        "id": e[0],
+        "username": e[1],
+        "type": e[2],
+        "room_id": e[3],
+        "timestamp": e[4],
+        "data": load_event_data(e[5]),
+    }
 
 class TankmasDb:
+    def get_db(self):
+        db = getattr(g, '_database', None)
+        if db is None:
+            db = g._database = self.pool.acquire()
+        return db
+
     def close(self):
-        db = get_db()
+        db = g.pop('_database', None)
         if db is not None:
-            db.close()
+            self.pool.release(db)
 
     def __init__(self, config):
+        # each shard of the sharded mode keeps its database in its own folder
+        self.data_dir = config["data_dir"] if "data_dir" in config else DATA_DIR
+        Path(self.data_dir).mkdir(parents=True, exist_ok=True)
+        self.pool = ConnectionPool(
+            os.path.join(self.data_dir, DATABASE_FILE),
+            size=config["db_pool_size"] if "db_pool_size" in config else 8,
+            synchronous=config["db_synchronous"] if "db_synchronous" in config else "NORMAL",
+            cache_size_kb=config["db_cache_size_kb"] if "db_cache_size_kb" in config else 20000,
+            mmap_size=config["db_mmap_size"] if "db_mmap_size" in config else 268435456,
+        )
         self.room_infos = {}
         self.user_def_vals = config["user_def_vals"]
-        self.user_event_timestamps = {}
+        # username -> [cursor, last poll time], for clients that don't track their own cursor
+        self.user_event_cursors = {}
         self.backup_interval = config["backup_interval"] if "backup_interval" in config else 1800
         self.last_backup = time.time()
+        self.backups = BackupManager(
+            self.pool.connect,
+            config["backup_dir"] if "backup_dir" in config else BACKUP_DIR,
+            pages_per_step=config["backup_pages_per_step"] if "backup_pages_per_step" in config else 256,
+            step_sleep_ms=config["backup_step_sleep_ms"] if "backup_step_sleep_ms" in config else 10,
+            keep_last=config["backup_keep_last"] if "backup_keep_last" in config else 10,
+            keep_daily=config["backup_keep_daily"] if "backup_keep_daily" in config else 7,
+            compress=config["backup_compress"] if "backup_compress" in config else False,
+        )
         self.max_idle_time = config["user_max_idle_time"]
 
+        # wakes long-pollers whenever a room's users or events move
+        self.changes = ChangeNotifier()
+
+        self.state = RoomState(self.max_idle_time, config["interest_cell_size"] if "interest_cell_size" in config else 256, self.changes.notify)
+        self.user_flush_interval = config["user_flush_interval"] if "user_flush_interval" in config else 1
+        self.last_user_flush = time.time()
+        # users that only refreshed their timestamp are written this often; kept
+        # well under the idle time so restarts and other workers still see them online
+        self.heartbeat_flush_interval = min(
+            config["user_heartbeat_flush_interval"] if "user_heartbeat_flush_interval" in config else 30,
+            self.max_idle_time / 4,
+        )
+        self.last_heartbeat_flush = time.time()
+        self.user_rows_written = 0
+        self.flush_lock = threading.Lock()
+        self.flush_db = None
+
+        self.event_queue_size = config["event_queue_size"] if "event_queue_size" in config else 4096
+        self.event_batch_size = config["event_batch_size"] if "event_batch_size" in config else 256
+        self.event_commit_interval_ms = config["event_commit_interval_ms"] if "event_commit_interval_ms" in config else 20
+        self.event_writer = None
+
+        self.saves = SaveCache(config["save_cache_bytes"] if "save_cache_bytes" in config else 16 * 1024 * 1024)
+        self.saves_written = 0
+        self.saves_skipped = 0
+
+        self.events = EventRing(config["event_ring_size"] if "event_ring_size" in config else 256, self.changes.notify)
+        self.event_backfill_limit = config["event_backfill_limit"] if "event_backfill_limit" in config else 500
+
+        # COUNT(*) walks the whole table, so it is only refreshed from the background loop
+        self.event_count = None
+        self.event_count_interval = config["event_count_interval"] if "event_count_interval" in config else 30
+        self.last_event_count = 0
+
+        self.retention = EventRetention(
+            self.pool.connect,
+            retention_age=config["event_retention_age"] if "event_retention_age" in config else 30 * 24 * 3600,
+            compact_age=config["event_compact_age"] if "event_compact_age" in config else 3600,
+            batch_size=config["event_retention_batch_size"] if "event_retention_batch_size" in config else 500,
+            budget_ms=config["event_retention_budget_ms"] if "event_retention_budget_ms" in config else 50,
+        )
+        self.retention_interval = config["event_retention_interval"] if "event_retention_interval" in config else 10
+        self.last_retention = 0
+
+        # several worker processes on one database file, see db/shared_state.py
+        self.multi_worker = config["multi_worker"] if "multi_worker" in config else False
+        self.shared = SharedState(self.pool.connect, config["leader_lease_ttl"] if "leader_lease_ttl" in config else 10) if self.multi_worker else None
+        # only the leader runs backups and cleanup; a single worker always leads
+        self.is_leader = not self.multi_worker
+        self.users_refreshed_at = time.time()
+        self.event_tail_interval = (config["event_tail_interval_ms"] if "event_tail_interval_ms" in config else 50) / 1000
+        self.last_event_tail = 0
+        self.tail_lock = threading.Lock()
+        self.tail_db = None
+        # username -> [cursor, last poll time] not yet written to event_cursors
+        self.dirty_cursors = {}
+        self.cursor_lock = threading.Lock()
+
     def init(self, config, app):
         print("Initializing DB...")
         self.init_db(app)
 
+        self.load_event_cursor()
+
+        self.event_writer = EventWriter(
+            self.pool.connect,
+            max_queue=self.event_queue_size,
+            batch_size=self.event_batch_size,
+            interval_ms=self.event_commit_interval_ms,
+            on_commit=self.events.committed,
+            max_retries=config["event_commit_retries"] if "event_commit_retries" in config else 5,
+        )
+
         for r in config["rooms"]: 
             self.upsert_room(r["id"], r["name"], r["identifier"])
             self.room_infos[r["id"]] = {
@@ -43,15 +253,32 @@ class TankmasDb:
                "maps": r["maps"],
             }
 
+        self.load_users()
+
     def init_db(self, app):
-        db = get_db()
+        db = self.get_db()
         with app.open_resource(INIT_FILE, mode='r') as f:
             init_script = f.read()
             db.cursor().executescript(init_script)
+        self.migrate_db()
         print("Inited DB")
+
+    def migrate_db(self):
+        db = self.get_db()
+        for table, columns in MIGRATIONS.items():
+            existing = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+            for name, column_type in columns:
+                if name not in existing:
+                    try:
+                        db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+                    except sqlite3.OperationalError as e:
+                        # another worker process added it first
+                        if "duplicate column" not in str(e):
+                            raise
+        db.commit()
             
     def upsert_room(self, room_id, room_identifier, room_name):
-        db = get_db()
+        db = self.get_db()
         cur = db.cursor()
         cur.execute("""
         INSERT INTO rooms(id, identifier, name) VALUES(?, ?, ?)
@@ -59,44 +286,71 @@ class TankmasDb:
         """, [room_id, room_identifier, room_name, room_name, room_identifier])
         db.commit()
     
-    def get_users(self, room_id = None):
-        db = get_db()
+    def user_rows(self, cur) -> list:
+        rows = []
+        for row in cur:
+            user_data = json.loads(row[7]) if row[7] is not None else {}
+            rows.append(row[:7] + (user_data, row[8]))
+        return rows
+
+    def load_users(self):
+        db = self.get_db()
         cur = db.cursor()
-        
-        filter = """
-            WHERE u.room_id = ?
-            AND u.last_timestamp > ?
-        """ if room_id is not None else ""
-        
-        values = [room_id, time.time() - self.max_idle_time] if filter != "" else ""
+        self.users_refreshed_at = time.time()
+        cur.execute(SELECT_USERS)
 
-        cur.execute("""
-            SELECT 
-                u.username, u.x, u.y, u.costume, u.sx, u.data, 
-                last_timestamp
-            FROM users u """+ filter, values)
-        
-        users = {} 
-        now = time.time()
-        for row in cur:
-            user_data = {}
-            if row[5] is not None:
-                user_data = json.loads(row[5])
-            users[row[0]] = {
-                "username": row[0],
-                "x": row[1],
-                "y": row[2],
-                "costume": row[3],
-                "sx": row[4],
-                "data": user_data,
-                "timestamp": row[6],
-                "online": row[6] + self.max_idle_time > now,
-            }
-            
-        return users
+        self.state.load(self.user_rows(cur))
+
+    # picks up the users other worker processes flushed since the last refresh
+    def refresh_users(self):
+        with self.flush_lock:
+            if self.flush_db is None:
+                self.flush_db = self.pool.connect()
+
+            since = self.users_refreshed_at - self.user_flush_interval - user_refresh_overlap
+            refreshed_at = time.time()
+            try:
+                rows = self.user_rows(self.flush_db.execute(SELECT_USERS_UPDATED, (since,)))
+            except sqlite3.Error as e:
+                print(f"USER REFRESH ERROR: {e}")
+                return 0
+            self.users_refreshed_at = refreshed_at
+
+        return self.state.apply_remote(rows)
 
-    def get_room(self, room_id):
-        users = self.get_users(room_id)
+    def load_event_cursor(self):
+        db = self.get_db()
+        cur = db.cursor()
+        cur.execute(SELECT_LAST_EVENT_ID)
+        last_id = cur.fetchone()[0]
+        self.events.reset(last_id if last_id is not None else 0)
+
+    # view is an optional {"map", "x", "y", "radius"} to only get nearby users
+    def get_users(self, room_id = None, view = None):
+        if room_id is not None:
+            room_id = int(room_id)
+        return self.state.get_users(room_id, view)
+
+    def get_room_changes(self, room_id, since, field_versions = False, view = None):
+        return self.state.get_changes(int(room_id), since, field_versions, view)
+
+    def get_room_version(self, room_id):
+        return self.state.get_version(int(room_id))
+
+    # true once the room moved past version, or has events after cursor
+    def room_changed(self, room_id, version, cursor = None) -> bool:
+        room_id = int(room_id)
+        if self.state.get_version(room_id) > version:
+            return True
+        return cursor is not None and self.events.latest(room_id) > cursor
+
+    # long-poll: blocks until room_changed() or timeout seconds; returns whether it changed
+    def wait_for_room(self, room_id, version, cursor, timeout) -> bool:
+        room_id = int(room_id)
+        return self.changes.wait(room_id, lambda: self.room_changed(room_id, version, cursor), timeout)
+
+    def get_room(self, room_id, view = None):
+        users = self.get_users(room_id, view)
         
         room_info = self.room_infos[int(room_id)]
         return {
@@ -106,200 +360,369 @@ class TankmasDb:
             "users": users
         }
         
-    def dump_info(self):
-        users = self.get_users()
-        events = self.get_events()
-        
-        return {
-            "users": users,
-            "events": events
-        }
-    
-    def upsert_user(self, username, room_id, x = None, y = None, sx = None, costume = None, data = None):
-        db = get_db()
-        cur = db.cursor()
+    def remove_user(self, username, room_id) -> bool:
+        return self.state.remove_user(username, int(room_id))
 
-        cur.execute("""
-        INSERT INTO users(username, room_id) VALUES(?, ?)
-            ON CONFLICT(username) DO NOTHING;
-        """, [username, room_id])
+    def upsert_user(self, username, room_id, x = None, y = None, sx = None, costume = None, data = None, map_name = None):
+        user = self.state.upsert_user(username, int(room_id), x, y, sx, costume, data, map_name)
 
-        field_names = []
-        field_values = []
+        request_for_more_info = False
+        for val in self.user_def_vals:
+            if user[val] is None:
+                request_for_more_info = True
 
+        return request_for_more_info
 
-        field_names.append('last_timestamp=?')
-        field_values.append(time.time())
+    def flush_users(self, heartbeats = True):
+        with self.flush_lock:
+            rows = self.state.take_dirty(heartbeats)
+            if len(rows) == 0:
+                return 0
 
-        field_names.append('room_id=?')
-        field_values.append(room_id)
-        
-        if x is not None:
-            field_names.append('x=?')
-            field_values.append(x)
-        if y is not None:
-            field_names.append('y=?')
-            field_values.append(y)
-        if sx is not None:
-            field_names.append('sx=?')
-            field_values.append(sx)
-        if costume is not None:
-            field_names.append('costume=?')
-            field_values.append(costume)
-        if data is not None:
-            field_names.append('data=?')
-            field_values.append(json.dumps(data))
-
-        field_values.append(username)
-        set_statement = ", ".join(field_names)
-      
-        query = "UPDATE users SET "+set_statement+"""
-            WHERE username = ?
-            RETURNING x, y, costume, sx
-            """
-
-        cur.execute(query, field_values)
+            if self.flush_db is None:
+                self.flush_db = self.pool.connect()
 
-        request_for_more_info = False
+            values = [r[:7] + (json.dumps(r[7]), r[8]) for r in rows]
+            try:
+                with self.flush_db:
+                    self.flush_db.executemany(UPSERT_USERS, values)
+            except sqlite3.Error as e:
+                print(f"USER FLUSH ERROR: {e}")
+                self.state.mark_dirty([r[0] for r in rows])
+                return 0
 
-        for r in cur:
-            user = {
-                "x": r[0],
-                "y": r[1],
-                "costume": r[2],
-                "sx": r[3]
-            }
-            
-            for val in self.user_def_vals:
-                if val not in user:
-                    request_for_more_info = True
+            self.user_rows_written += len(rows)
+            return len(rows)
 
-        db.commit()
+    def refresh_event_count(self):
+        with self.flush_lock:
+            if self.flush_db is None:
+                self.flush_db = self.pool.connect()
+            try:
+                self.event_count = self.flush_db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            except sqlite3.Error as e:
+                print(f"EVENT COUNT ERROR: {e}")
+
+    def shutdown(self):
+        self.flush_users()
+        if self.event_writer is not None:
+            self.event_writer.stop()
+        if self.shared is not None:
+            self.flush_event_cursors()
+            self.shared.release_lease("leader")
+            self.shared.close()
+        self.retention.close()
+        self.pool.close_all()
+
+    # how many position updates reached SQLite; avoided is the share that didn't
+    def user_stats(self) -> dict:
+        stats = self.state.stats()
+        stats["written"] = self.user_rows_written
+        stats["avoided"] = 1 - self.user_rows_written / stats["updates"] if stats["updates"] > 0 else 0
+        return stats
+
+    def stats(self) -> dict:
+        return {
+            "events": self.event_writer.stats(),
+            "connections": self.pool.stats(),
+            "backups": self.backups.stats(),
+            "saves": dict(self.saves.stats(), written=self.saves_written, skipped=self.saves_skipped),
+            "users": self.user_stats(),
+            "retention": self.retention.stats(),
+            "shared": self.shared.stats() if self.shared is not None else None,
+        }
 
-        return request_for_more_info
-    
     def log_event():
         pass
     
+    # returns an EventWrite; wait() on it for durability, raises EventQueueFull under backpressure
     def post_event(self, username, event_type, data, room_id = None):
-        db = get_db()
-        cur = db.cursor()
-        timestamp = time.time()
-        cur.execute("""
-        INSERT INTO events(timestamp, username, type, data, room_id) VALUES(?, ?, ?, ?, ?)
-        """, (timestamp, username, event_type, json.dumps(data), room_id))
-        db.commit()
-    
-    def get_events(self):
-        db = get_db()
-        cur = db.cursor()
-        cur.execute("""
-            SELECT username, type, room_id, timestamp, data
-            FROM events 
-        """)
-        
-        events = []
-        for e in cur:
-            events.append({
-                "username": e[0],
-                "type": e[1],
-                "room_id": e[2],
-                "timestamp": e[3],
-                "data": json.loads(e[4]) if e[4] is not None else None,
-            })
-        
-        return events
+        if room_id is not None:
+            room_id = int(room_id)
+
+        self.event_writer.reserve()
+
+        # with several workers SQLite assigns the id and the event reaches every
+        # worker's ring through tail_events
+        if self.shared is not None:
+            return self.event_writer.post((None, time.time(), username, event_type, json.dumps(data), room_id))
+
+        event = self.events.append(room_id, {
+            "username": username,
+            "type": event_type,
+            "room_id": room_id,
+            "timestamp": time.time(),
+            "data": data,
+        })
+
+        return self.event_writer.post((event["id"], event["timestamp"], username, event_type, json.dumps(data), room_id))
     
-    def get_new_events(self, username, room_id):
-        last_timestamp = self.user_event_timestamps[username] if username in self.user_event_timestamps else time.time()
-        self.user_event_timestamps[username] = time.time()
-        
-        db = get_db()
+    # Yields lists of rows from table with id > after_id, oldest first, paging by
+    # id. filters is a list of (sql condition, value).
+    def stream_rows(self, query, after_id, limit, filters):
+        conditions = "".join(f" AND {condition}" for condition, _ in filters)
+        sql = f"{query} WHERE id > ?{conditions} ORDER BY id LIMIT ?"
+        values = [value for _, value in filters]
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            chunk = dump_chunk_size if remaining is None else min(dump_chunk_size, remaining)
+            rows = self.get_db().execute(sql, [after_id] + values + [chunk]).fetchall()
+            if len(rows) == 0:
+                return
+            yield rows
+            after_id = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+            if len(rows) < chunk:
+                return
+
+    def dump_filters(self, room_id, since, until, timestamp_column) -> list:
+        filters = []
+        if room_id is not None:
+            filters.append(("room_id = ?", int(room_id)))
+        if since is not None:
+            filters.append((f"{timestamp_column} >= ?", since))
+        if until is not None:
+            filters.append((f"{timestamp_column} < ?", until))
+        return filters
+
+    # events with id > after_id as lists of dicts; since/until are unix times
+    def stream_events(self, after_id = 0, limit = None, room_id = None, since = None, until = None):
+        query = "SELECT id, username, type, room_id, timestamp, data FROM events"
+        filters = self.dump_filters(room_id, since, until, "timestamp")
+        for rows in self.stream_rows(query, after_id, limit, filters):
+            yield [event_from_row(e) for e in rows]
+
+    # the users table, paged by its row id; recent positions are flushed first
+    def stream_users(self, after_id = 0, limit = None, room_id = None, since = None, until = None):
+        self.flush_users()
+        query = "SELECT id, username, room_id, map, x, y, costume, sx, data, last_timestamp FROM users"
+        filters = self.dump_filters(room_id, since, until, "last_timestamp")
+        for rows in self.stream_rows(query, after_id, limit, filters):
+            yield [{
+                "id": row[0],
+                "username": row[1],
+                "room_id": row[2],
+                "map": row[3],
+                "x": row[4],
+                "y": row[5],
+                "costume": row[6],
+                "sx": row[7],
+                "data": json.loads(row[8]) if row[8] is not None else {},
+                "timestamp": row[9],
+            } for row in rows]
+
+    # returns (events after the cursor, new cursor). Without a cursor the server
+    # remembers where each username left off.
+    def get_new_events(self, username, room_id, since = None):
+        room_id = int(room_id)
+        now = time.time()
+
+        if self.shared is not None and now - self.last_event_tail >= self.event_tail_interval:
+            self.tail_events()
+
+        tracked = since is None
+        if tracked:
+            entry = self.get_event_cursor(username)
+            since = entry[0] if entry is not None else self.events.current()
+        since = min(since, self.events.current())
+
+        events, horizon = self.events.since(room_id, since)
+        cursor = since
+
+        if since < horizon:
+            older = self.get_events_between(room_id, since, horizon)
+            if len(older) >= self.event_backfill_limit:
+                events = older
+            else:
+                events = older + events
+                cursor = horizon
+
+        if len(events) > 0:
+            cursor = events[-1]["id"]
+
+        if tracked:
+            self.set_event_cursor(username, cursor, now)
+
+        return events, cursor
+
+    def get_event_cursor(self, username):
+        if self.shared is None:
+            return self.user_event_cursors.get(username)
+
+        with self.cursor_lock:
+            entry = self.dirty_cursors.get(username)
+        if entry is not None:
+            return entry
+
+        cur = self.get_db().cursor()
+        cur.execute(SELECT_EVENT_CURSOR, [username])
+        row = cur.fetchone()
+        return list(row) if row is not None else None
+
+    def set_event_cursor(self, username, cursor, now):
+        if self.shared is None:
+            with self.cursor_lock:
+                self.user_event_cursors[username] = [cursor, now]
+            return
+
+        with self.cursor_lock:
+            self.dirty_cursors[username] = [cursor, now]
+
+    def flush_event_cursors(self):
+        with self.cursor_lock:
+            dirty = self.dirty_cursors
+            self.dirty_cursors = {}
+        if len(dirty) == 0:
+            return
+
+        if not self.shared.put_cursors([(u, entry[0], entry[1]) for u, entry in dirty.items()]):
+            with self.cursor_lock:
+                for username, entry in dirty.items():
+                    self.dirty_cursors.setdefault(username, entry)
+
+    # pulls the events any worker committed into the ring, in id order; SQLite has
+    # a single writer, so ids become visible in the order they were handed out
+    def tail_events(self):
+        if not self.tail_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_event_tail = time.time()
+            if self.tail_db is None:
+                self.tail_db = self.pool.connect()
+
+            while True:
+                rows = self.tail_db.execute(SELECT_EVENTS_AFTER, (self.events.current(), self.event_backfill_limit)).fetchall()
+                self.events.extend([event_from_row(e) for e in rows])
+                if len(rows) < self.event_backfill_limit:
+                    break
+        except sqlite3.Error as e:
+            print(f"EVENT TAIL ERROR: {e}")
+        finally:
+            self.tail_lock.release()
+
+    # events the ring no longer holds, read with the (room_id, id) index
+    def get_events_between(self, room_id, after_id, up_to_id):
+        db = self.get_db()
         cur = db.cursor()
-        cur.execute("""
-            SELECT username, type, room_id, timestamp, data
-            FROM events 
-            WHERE
-                timestamp >= ?
-            AND
-                room_id = ?
-        """, (last_timestamp, room_id))
-        
-        events = []
-        for e in cur:
-            events.append({
-                "username": e[0],
-                "type": e[1],
-                "room_id": e[2],
-                "timestamp": e[3],
-                "data": json.loads(e[4]) if e[4] is not None else None,
-            })
-        
-        return events
-    
+        cur.execute(SELECT_EVENTS_BETWEEN, (room_id, after_id, up_to_id, self.event_backfill_limit))
+
+        return [event_from_row(e) for e in cur]
+
+    def cleanup_event_cursors(self):
+        cutoff = time.time() - self.max_idle_time
+        # request threads add cursors while this runs
+        with self.cursor_lock:
+            for username in [u for u, entry in self.user_event_cursors.items() if entry[1] < cutoff]:
+                del self.user_event_cursors[username]
+
+        if self.shared is not None and self.is_leader:
+            self.shared.cleanup_cursors(cutoff)
+
     def get_user(self, username):
-        db = get_db()
-        cur = db.cursor()
-        cur.execute("""
-            SELECT 
-                u.username, u.x, u.y, u.costume, u.sx, u.data, 
-                u.last_timestamp, u.room_id, r.name
-            FROM users u
-            JOIN rooms r on r.id = u.room_id
-            WHERE u.username = ?
-        """, [username])
-        
-        user = None
-        for row in cur:
-            user_data = {}
-            if row[5] is not None:
-                user_data = json.loads(row[5])
-            user = {
-                "username": row[0],
-                "x": row[1],
-                "y": row[2],
-                "costume": row[3],
-                "sx": row[4],
-                "data": user_data,
-                "timestamp": row[6],
-                "room_id": row[7],
-                "room_name": row[8]
-            }
+        user = self.state.get_user(username)
+        if user is None or user["room_id"] not in self.room_infos:
+            return None
+
+        user["room_name"] = self.room_infos[user["room_id"]]["name"]
         return user
     
+    # saves are stored zlib-compressed next to their hash; returns False when the
+    # posted save matches the stored one and the write was skipped
     def save_user_file(self, username, data):
-        db = get_db()
-        cur = db.cursor()
+        save_hash = hash_save(data)
 
-        cur.execute("""
-        INSERT INTO saves(username, data, save_time) VALUES(?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(username) DO UPDATE SET data=?, save_time=CURRENT_TIMESTAMP;
-        """, [username, data, data])
+        cached = self.saves.get(username)
+        stored_hash = cached[0] if cached is not None and self.shared is None else self.get_save_hash(username)
+        if stored_hash == save_hash:
+            self.saves_skipped += 1
+            if cached is None:
+                self.saves.put(username, save_hash, data)
+            return False
+
+        db = self.get_db()
+        cur = db.cursor()
+        cur.execute(UPSERT_SAVE, [username, zlib.compress(data.encode()), save_hash])
         db.commit()
 
-    def load_user_file(self, username):
-        db = get_db()
+        self.saves.put(username, save_hash, data)
+        self.saves_written += 1
+        return True
+
+    # other workers may have written a newer save, so with several workers the
+    # cache is only trusted when its hash matches the stored one
+    def get_save_hash(self, username):
+        cached = self.saves.get(username)
+        if cached is not None and self.shared is None:
+            return cached[0]
+
+        db = self.get_db()
         cur = db.cursor()
+        cur.execute(SELECT_SAVE_HASH, [username])
+        row = cur.fetchone()
+        return row[0] if row is not None else None
 
-        cur.execute("""
-        SELECT data FROM saves
-        WHERE username = ?
-        """, [username])
-        
-        data = None;
-        for s in cur:
-            data = s[0]
+    # returns (data, hash)
+    def load_user_save(self, username):
+        cached = self.saves.get(username)
+        if cached is not None and (self.shared is None or cached[0] == self.get_save_hash(username)):
+            return cached[1], cached[0]
+
+        db = self.get_db()
+        cur = db.cursor()
+        cur.execute(SELECT_SAVE, [username])
+        row = cur.fetchone()
+        if row is None:
+            return None, None
+
+        data, data_z, save_hash = row
+        if data_z is not None:
+            data = zlib.decompress(data_z).decode()
+        if save_hash is None:
+            # written before saves were hashed
+            save_hash = hash_save(data)
 
+        self.saves.put(username, save_hash, data)
+        return data, save_hash
+
+    def load_user_file(self, username):
+        data, _ = self.load_user_save(username)
         return data
 
+    # runs on the backup thread; returns False if the previous one hasn't finished
     def backup(self):
-        Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-        backup_name = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S-backup.db")
-        shutil.copy(DATABASE, f"{BACKUP_DIR}/{backup_name}")
-        pass
+        return self.backups.start()
     
     def process(self):
         cur_time = time.time()
+        if self.shared is not None:
+            self.is_leader = self.shared.update_leader()
+            self.refresh_users()
+            self.tail_events()
+            self.flush_event_cursors()
+
+        if cur_time - self.last_user_flush >= self.user_flush_interval:
+            self.last_user_flush = cur_time
+            heartbeats = cur_time - self.last_heartbeat_flush >= self.heartbeat_flush_interval
+            if heartbeats:
+                self.last_heartbeat_flush = cur_time
+            self.flush_users(heartbeats)
+
+        self.cleanup_event_cursors()
+        self.state.expire_idle()
+
+        if not self.is_leader:
+            return
+
+        if cur_time - self.last_retention >= self.retention_interval:
+            self.last_retention = cur_time
+            self.retention.step()
+
+        if cur_time - self.last_event_count >= self.event_count_interval:
+            self.last_event_count = cur_time
+            self.refresh_event_count()
+
         delta = cur_time - self.last_backup
         if delta > self.backup_interval:
             self.last_backup = cur_time
@@ -2,4 +2,5 @@ from managers.event_manager import EventManager
 from managers.hit_manager import HitManager
 from managers.premiere_manager import PremiereManager
 from managers.room_manager import RoomManager
-from managers.save_manager import SaveManager
\ No newline at end of file
+from managers.save_manager import SaveManager
+from managers.snapshot_manager import SnapshotManager
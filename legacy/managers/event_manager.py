@@ -1,44 +1,305 @@
+import bisect
+import gzip
+import json
+import os
+import shutil
+import threading
 import time
 from pathlib import Path
-import os
-
-from tools import load_json, write_json
 
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on Windows, which only runs a single worker anyway
+    fcntl = None
+
+from tools import load_json
+
+# Events are appended as JSON lines to numbered segment files. The active segment
+# rotates once it reaches segment_max_bytes, and closed segments beyond the newest
+# max_before_archive are gzipped into the archive folder. Nothing is ever rewritten.
+#
+# A restart keeps appending to the last segment while it has room. Each worker
+# holds a lock on the segment it writes to, so two workers never share one: a
+# worker that can't get the last segment, or the next id, moves on to the next.
+#
+# An event's seq follows the clock in microseconds and its worker is the pid of
+# the process that wrote it, so (seq, worker) is unique across workers and the
+# latest event per (username, type) is the one written last.
+
+log_dir = "data/events/log"
+archive_dir = "data/events/archive"
+requests_log_path = "data/events/requests-log.jsonl"
+# held while a worker opens the request log, so it isn't compacted under a worker that has it open
+requests_lock_path = "data/events/requests-log.lock"
+# latest event per (username, type) as of the last archive, since archived segments aren't replayed
+latest_path = "data/events/latest.json"
+
+# pre-segment files, imported once and then renamed out of the way
 current_events_path = "data/events/events.json"
-archived_events_path = "data/events/events-archive.json"
-requests_log_path = "data/events/requests-log.json"
+legacy_requests_log_path = "data/events/requests-log.json"
+
+segment_max_bytes = 1024 * 1024
 
+# closed segments kept uncompressed before they are archived
 max_before_archive = 5
 
-timestamp_diff_limit = 9999
+# one (timestamp, offset) entry is kept per this many lines of a segment
+index_every = 32
+
+
+def segment_name(segment_id) -> str:
+    return f"events-{segment_id:06d}.jsonl"
+
+
+# events from before workers were recorded count as worker 0
+def seq_key(event) -> tuple:
+    return (event["seq"], event["worker"] if "worker" in event else 0)
+
+
+class Segment:
+    def __init__(self, segment_id):
+        self.id = segment_id
+        self.path = f"{log_dir}/{segment_name(segment_id)}"
+        self.lines = 0
+        self.size = 0
+        self.last_timestamp = 0
+        # sparse seek index
+        self.index_timestamps = []
+        self.index_offsets = []
+
+    def track(self, event, offset, size):
+        if self.lines % index_every == 0:
+            self.index_timestamps.append(event["timestamp"])
+            self.index_offsets.append(offset)
+        self.lines += 1
+        self.size = offset + size
+        self.last_timestamp = max(self.last_timestamp, event["timestamp"])
+
+    # byte offset to start reading from for events after timestamp
+    def seek_offset(self, timestamp) -> int:
+        i = bisect.bisect_right(self.index_timestamps, timestamp) - 1
+        return self.index_offsets[i] if i >= 0 else 0
 
 
 class EventManager:
     def __init__(self):
-        self.access_log = {}
-
-        Path("data/events").mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
 
-        for file_path in [current_events_path, archived_events_path]:
-            if not os.path.isfile(file_path):
-                write_json(file_path, {"events": []})
+        Path(log_dir).mkdir(parents=True, exist_ok=True)
+        Path(archive_dir).mkdir(parents=True, exist_ok=True)
 
-        if not os.path.isfile(requests_log_path):
-            write_json(requests_log_path, {"entries": []})
-        # with open(current_events_path, "r") as file:
-        # self.events_log = json.loads()
+        self.seq = 0
+        self.worker = os.getpid()
+        self.segments = []
+        # (username, type) -> latest event, last write wins
+        self.latest = {}
+        # username -> timestamp of their last get_events_since
+        self.access_log = {}
 
+        self.load_checkpoint()
+        self.load_segments()
+        self.load_request_log()
+
+        self.active = None
+        self.start_segment()
+
+        self.import_legacy_events()
+
+    def load_checkpoint(self):
+        if os.path.isfile(latest_path):
+            data = load_json(latest_path)
+            if data is not None:
+                for event in data["events"]:
+                    self.index_event(event)
+
+    def write_checkpoint(self):
+        # per process temp names, several workers may checkpoint at once
+        tmp_path = f"{latest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"events": list(self.latest.values())}, file)
+        os.replace(tmp_path, latest_path)
+
+    def load_segments(self):
+        names = sorted(n for n in os.listdir(log_dir) if n.startswith("events-") and n.endswith(".jsonl"))
+        for name in names:
+            segment = Segment(int(name[len("events-"):-len(".jsonl")]))
+            with open(segment.path, "rb") as file:
+                offset = 0
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # torn final line from a crash
+                        break
+                    segment.track(event, offset, len(line))
+                    offset += len(line)
+                    self.index_event(event)
+            self.segments.append(segment)
+
+    def load_request_log(self):
+        # Held while the log is read, compacted and opened. The log is only compacted
+        # when no other worker has it open, since their appends would go to the
+        # replaced file; afterwards it is append-only. Every worker keeps a shared
+        # lock on the log it appends to.
+        with open(requests_lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if os.path.isfile(requests_log_path):
+                with open(requests_log_path, "r") as file:
+                    for line in file:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break
+                        self.access_log[entry["username"]] = entry["timestamp"]
+
+            if os.path.isfile(legacy_requests_log_path):
+                data = load_json(legacy_requests_log_path)
+                if data is not None:
+                    for entry in data["entries"]:
+                        self.access_log.setdefault(entry["username"], entry["timestamp"])
+                os.replace(legacy_requests_log_path, legacy_requests_log_path + ".imported")
+
+            self.requests_file = open(requests_log_path, "a")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self.requests_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    fcntl.flock(self.requests_file, fcntl.LOCK_SH)
+                    return
+
+            tmp_path = f"{requests_log_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                for username, timestamp in self.access_log.items():
+                    file.write(json.dumps({"username": username, "timestamp": timestamp}) + "\n")
+            os.replace(tmp_path, requests_log_path)
+            self.requests_file.close()
+            self.requests_file = open(requests_log_path, "a")
+            if fcntl is not None:
+                fcntl.flock(self.requests_file, fcntl.LOCK_SH)
+
+    def import_legacy_events(self):
+        if not os.path.isfile(current_events_path):
+            return
+        data = load_json(current_events_path)
+        if data is not None:
+            for event in sorted(data["events"], key=lambda n: n["timestamp"]):
+                self.append(event)
+        os.replace(current_events_path, current_events_path + ".imported")
+
+    def index_event(self, event):
+        self.seq = max(self.seq, event["seq"])
+        key = (event["username"], event["type"])
+        current = self.latest.get(key)
+        if current is None or seq_key(current) < seq_key(event):
+            self.latest[key] = event
+
+    # opens segment's file and locks it; False if it exists (for "xb") or another worker has it
+    def claim_segment(self, segment, mode) -> bool:
+        try:
+            file = open(segment.path, mode)
+        except FileExistsError:
+            return False
+        if fcntl is not None:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                file.close()
+                return False
+
+        if self.active is not None:
+            self.active_file.close()
+        self.active = segment
+        self.active_file = file
+        return True
+
+    # keeps writing to the last segment if it has room and its tail is whole
+    def start_segment(self):
+        if len(self.segments) > 0:
+            last = self.segments[-1]
+            if last.size < segment_max_bytes and os.path.getsize(last.path) == last.size and self.claim_segment(last, "ab"):
+                return
+        self.open_segment(self.segments[-1].id + 1 if len(self.segments) > 0 else 1)
+
+    # creates a new segment at the first free id from segment_id on
+    def open_segment(self, segment_id):
+        while True:
+            segment = Segment(segment_id)
+            if self.claim_segment(segment, "xb"):
+                self.segments.append(segment)
+                return
+            segment_id += 1
+
+    def append(self, event) -> dict:
+        with self.lock:
+            self.seq = max(self.seq + 1, int(time.time() * 1000000))
+            event["seq"] = self.seq
+            event["worker"] = self.worker
+            line = (json.dumps(event) + "\n").encode()
+
+            if self.active.size > 0 and self.active.size + len(line) > segment_max_bytes:
+                self.open_segment(self.active.id + 1)
+                self.archive_old_segments()
+
+            self.active_file.write(line)
+            self.active_file.flush()
+            self.active.track(event, self.active.size, len(line))
+            self.index_event(event)
+
+        return event
+
+    def archive_segment(self, segment):
+        with open(segment.path, "rb") as f_in:
+            # another worker is still writing it
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f_in, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return
+            with gzip.open(f"{archive_dir}/{segment_name(segment.id)}.gz", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(segment.path)
+        self.segments.remove(segment)
+
+    def archive_old_segments(self):
+        closed = self.segments[:-1]
+        archive = closed[:max(0, len(closed) - max_before_archive)]
+        if len(archive) > 0:
+            self.write_checkpoint()
+        for segment in archive:
+            self.archive_segment(segment)
+
+    # rotates the active segment and archives everything that was written so far
     def archive_all(self):
-        pass
+        with self.lock:
+            if self.active.lines == 0:
+                closed = self.segments[:-1]
+            else:
+                self.open_segment(self.active.id + 1)
+                closed = self.segments[:-1]
+            self.write_checkpoint()
+            for segment in closed:
+                self.archive_segment(segment)
 
     def get_current_events(self) -> dict:
-        return load_json(current_events_path)
+        with self.lock:
+            events = sorted(self.latest.values(), key=lambda n: n["timestamp"])
+        return {"events": events}
 
     def get_archived_events(self) -> dict:
-        return load_json(archived_events_path)
+        events = []
+        for name in sorted(os.listdir(archive_dir)):
+            with gzip.open(f"{archive_dir}/{name}", "rb") as file:
+                for line in file:
+                    events.append(json.loads(line))
+        return {"events": events}
 
     def get_request_log(self) -> dict:
-        return load_json(requests_log_path)
+        with self.lock:
+            entries = [{"username": u, "timestamp": t} for u, t in self.access_log.items()]
+        return {"entries": sorted(entries, key=lambda d: d["timestamp"])}
 
     def post_event(self, username: str, event_type: str, data):
         timestamp = time.time()
@@ -50,78 +311,44 @@ class EventManager:
             "username": username,
         }
 
-        self.write_event_to_file(event)
+        self.append(event)
 
+    # events from other users after this user's previous request, read by seeking
+    # into the segments instead of scanning everything
     def get_events_since(self, username: str, current_timestamp: int) -> dict:
-        data = self.get_current_events()
-        events = data["events"]
+        with self.lock:
+            prev_timestamp = self.access_log[username] if username in self.access_log else 0
+            compare_timestamp = prev_timestamp if prev_timestamp > 0 else current_timestamp
+            segments = [s for s in self.segments if s.last_timestamp > compare_timestamp]
+            self.active_file.flush()
 
-        prev_timestamp = 0
         events_since = []
-
-        for entry in self.get_request_log()["entries"]:
-            if entry["username"] == username:
-                prev_timestamp = entry["timestamp"]
-
-        # for testing
-        # prev_timestamp = 5
-
-        compare_timestamp = prev_timestamp if prev_timestamp > 0 else current_timestamp
-
-        for event in events:
-            if username != event["username"]:
-                print(
-                    compare_timestamp,
-                    event["timestamp"],
-                    event["timestamp"] > compare_timestamp,
-                )
-                if event["timestamp"] > compare_timestamp:
-                    events_since.append(event)
-                    print(events_since)
+        for segment in segments:
+            try:
+                file = open(segment.path, "rb")
+            except FileNotFoundError:
+                # archived in the meantime
+                continue
+            with file:
+                file.seek(segment.seek_offset(compare_timestamp))
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        break
+                    if event["timestamp"] <= compare_timestamp or event["username"] == username:
+                        continue
+                    # superseded events stay in the log but aren't current anymore
+                    current = self.latest.get((event["username"], event["type"]))
+                    if current is not None and seq_key(current) == seq_key(event):
+                        events_since.append(event)
 
         self.log_request(username, current_timestamp)
 
         return events_since
 
-    def write_event_to_file(self, event) -> list:
-        data = self.get_current_events()
-        events = data["events"]
-
-        exists_already = False
-        for n in range(0, len(events)):
-            if events[n]["username"] == event["username"]:
-                if events[n]["type"] == event["type"]:
-                    events[n] = event
-                    exists_already = True
-                    break
-
-        if not exists_already:
-            events.append(event)
-
-        events = sorted(events, key=lambda n: n["timestamp"])
-
-        data["events"] = events
-        write_json(current_events_path, data)
-
-        return events
-
     def log_request(self, username: str, timestamp: int):
-        data = self.get_request_log()
-        entries = data["entries"]
-
-        exists_already = False
-        for existing_entry in entries:
-            if existing_entry["username"] == username:
-                existing_entry["timestamp"] = timestamp
-                exists_already = True
-                break
-
-        if not exists_already:
-            new_entry = {"username": username, "timestamp": timestamp}
-            entries.append(new_entry)
-
-        entries = sorted(entries, key=lambda d: d["timestamp"])
-
-        data["entries"] = entries
-
-        write_json(requests_log_path, data)
+        with self.lock:
+            self.access_log[username] = timestamp
+            self.requests_file.write(json.dumps({"username": username, "timestamp": timestamp}) + "\n")
+            self.requests_file.flush()
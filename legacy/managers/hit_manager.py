@@ -1,39 +1,150 @@
-import json
 import time
-import math
-from pathlib import Path
+import threading
 
-user_def_vals = ["x", "y", "costume", "sx"]
 base_client_tick_rate = 500
 
+# requests that aren't for a particular room only count towards this bucket
+global_key = "global"
 
-class HitManager:
-    def __init__(self):
+# latency samples kept per bucket per interval
+max_samples = 2048
+
+
+class LoadBucket:
+    def __init__(self, tick_rate):
         self.hits = 0
-        self.attrition_rate = 5
+        self.samples = []
+        self.rate = 0.0
+        self.p95_ms = 0.0
+        self.pressure = 0.0
+        self.tick_rate = tick_rate
+
+    def record(self, latency_ms):
+        self.hits += 1
+        if len(self.samples) < max_samples:
+            self.samples.append(latency_ms)
+        else:
+            self.samples[self.hits % max_samples] = latency_ms
+
+
+# Load-adaptive tick rate. Every interval each bucket folds its request rate and
+# p95 handler latency into an EWMA, turns that into a pressure (1.0 = at target)
+# and only moves the tick rate it hands to clients when the target drifts past
+# the hysteresis band, a bounded step at a time.
+#
+# With several worker processes each one only sees its share of the requests, so
+# when a SharedState is given the workers exchange their raw rates and p95s and
+# all steer by the combined load.
+class HitManager:
+    def __init__(self, config = None, shared = None):
+        config = config if config is not None else {}
+        self.shared = shared
+
+        self.base_tick_rate = config["tick_rate_base"] if "tick_rate_base" in config else base_client_tick_rate
+        self.min_tick_rate = config["tick_rate_min"] if "tick_rate_min" in config else self.base_tick_rate
+        self.max_tick_rate = config["tick_rate_max"] if "tick_rate_max" in config else self.base_tick_rate * 10
+        self.target_room_rate = config["tick_rate_target_room_rate"] if "tick_rate_target_room_rate" in config else 200
+        self.target_global_rate = config["tick_rate_target_global_rate"] if "tick_rate_target_global_rate" in config else 1000
+        self.target_p95_ms = config["tick_rate_target_p95_ms"] if "tick_rate_target_p95_ms" in config else 50
+        self.alpha = config["tick_rate_ewma_alpha"] if "tick_rate_ewma_alpha" in config else 0.3
+        self.hysteresis = config["tick_rate_hysteresis"] if "tick_rate_hysteresis" in config else 0.15
+        self.max_step = config["tick_rate_max_step"] if "tick_rate_max_step" in config else 1.5
+
+        self.lock = threading.Lock()
         self.interval = 1
-        self.last_update_timestamp = 0
-        self.current_client_tick_rate = base_client_tick_rate
+        self.last_update_timestamp = time.time()
+        self.buckets = {global_key: LoadBucket(self.base_tick_rate)}
+        # only configured rooms get a bucket of their own
+        self.room_keys = {str(room["id"]) for room in config["rooms"]} if "rooms" in config else None
+        # running totals since start, for benchmarks
+        self.total_requests = 0
+        self.total_ms = 0.0
 
-    def hit(self) -> int:
-        self.hits = self.hits + 1
-        return self.hits
+    def get_bucket(self, key) -> LoadBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = LoadBucket(self.buckets[global_key].tick_rate)
+        return bucket
 
-    def update_attrition_rate(self) -> int:
-        self.attrition_rate = math.floor(self.hits / self.attrition_rate)
-        if self.attrition_rate < 1:
-            self.attrition_rate = 1
+    def record(self, room_id, latency_ms):
+        with self.lock:
+            self.total_requests += 1
+            self.total_ms += latency_ms
+            self.buckets[global_key].record(latency_ms)
+            if room_id is not None and (self.room_keys is None or str(room_id) in self.room_keys):
+                self.get_bucket(str(room_id)).record(latency_ms)
 
-        return self.attrition_rate
+    def get_tick_rate(self, room_id = None) -> int:
+        bucket = self.buckets.get(str(room_id)) if room_id is not None else None
+        if bucket is None:
+            bucket = self.buckets[global_key]
+        return int(bucket.tick_rate)
 
-    def get_tick_rate(self) -> int:
-        return self.client_tick_rate
+    def p95(self, samples) -> float:
+        if len(samples) == 0:
+            return 0.0
+        samples.sort()
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
 
-    def update_tick_rate(self) -> int:
+    def next_tick_rate(self, current, pressure) -> float:
+        target = self.base_tick_rate * max(pressure, 1e-9)
+        target = min(self.max_tick_rate, max(self.min_tick_rate, target))
+
+        if abs(target - current) <= current * self.hysteresis:
+            return current
+
+        if target > current:
+            return min(target, current * self.max_step)
+        return max(target, current / self.max_step)
+
+    def update_tick_rate(self):
         timestamp = time.time()
+        elapsed = timestamp - self.last_update_timestamp
+        if elapsed < self.interval:
+            return
+
+        with self.lock:
+            self.last_update_timestamp = timestamp
+
+            load = {}
+            for key, bucket in self.buckets.items():
+                load[key] = (bucket.hits / elapsed, self.p95(bucket.samples))
+                bucket.hits = 0
+                bucket.samples = []
+
+        if self.shared is not None:
+            load = self.shared.exchange_load(load, self.interval * 3)
+
+        with self.lock:
+            for key, (rate, p95_ms) in load.items():
+                bucket = self.get_bucket(key)
+                bucket.rate += self.alpha * (rate - bucket.rate)
+                bucket.p95_ms += self.alpha * (p95_ms - bucket.p95_ms)
+
+            for key, bucket in self.buckets.items():
+                target_rate = self.target_global_rate if key == global_key else self.target_room_rate
+                bucket.pressure = max(bucket.rate / target_rate, bucket.p95_ms / self.target_p95_ms)
+
+            # a server-wide overload slows every room down, a busy room only itself
+            global_pressure = self.buckets[global_key].pressure
+            for key, bucket in self.buckets.items():
+                bucket.tick_rate = self.next_tick_rate(bucket.tick_rate, max(bucket.pressure, global_pressure))
 
-        if timestamp - self.last_update_timestamp >= self.interval:
-            self.update_attrition_rate()
-            self.client_tick_rate = base_client_tick_rate * self.attrition_rate
-            self.hits = 0
-            self.last_hits_update_time = timestamp
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "base_tick_rate": self.base_tick_rate,
+                "min_tick_rate": self.min_tick_rate,
+                "max_tick_rate": self.max_tick_rate,
+                "requests": self.total_requests,
+                "request_ms": self.total_ms,
+                "buckets": {
+                    key: {
+                        "rate": bucket.rate,
+                        "p95_ms": bucket.p95_ms,
+                        "pressure": bucket.pressure,
+                        "tick_rate": int(bucket.tick_rate),
+                    }
+                    for key, bucket in self.buckets.items()
+                },
+            }
@@ -1,11 +1,22 @@
 from pathlib import Path
+import hashlib
+import json
 import os
+import threading
+import time
 from tools import load_json, write_json
 
 from datetime import datetime
 
 premiere_file = "data/premieres.json"
 
+# how often the file's mtime is checked for edits
+reload_check_interval = 1
+
+# longest time clients may cache the schedule, so edits reach them even when the
+# next release is far away
+max_cache_age = 60
+
 '''
 example json file:
 {
@@ -22,6 +33,9 @@ example json file:
 }
 '''
 
+# The schedule is parsed once into a list sorted by release time and the
+# response is built once per release: it only changes when the next premiere
+# goes live (its url gets revealed) or when the file is edited.
 class PremiereManager:
 	def __init__(self) -> None:
 		Path("data").mkdir(parents=True, exist_ok=True)
@@ -36,35 +50,100 @@ class PremiereManager:
 					"url": "https://uploads.ungrounded.net/alternate/6243000/6243882_alternate_289698.720p.mp4?1732833997"
 				}
 			}})
+
+		self.lock = threading.Lock()
+		self.mtime = None
+		self.last_reload_check = 0
+		# (release_timestamp, name, date, url), sorted by release
+		self.schedule = []
+		# (package, etag, expires) for the current release window
+		self.cached = None
+
 		premiere_data = load_json(premiere_file)
 		if premiere_data["premieres"] is None:
 			raise Exception("No premieres found")
-		self.premieres = premiere_data["premieres"]
+		self.load(premiere_data, os.stat(premiere_file).st_mtime)
+
+	def load(self, premiere_data, mtime):
+		schedule = []
+		for name, p in premiere_data["premieres"].items():
+			try:
+				release_date = datetime.strptime(p["time"], '%Y-%m-%d %I:%M%p')
+			except (KeyError, ValueError) as e:
+				print(f"PREMIERE PARSE ERROR @ {name}: {e}")
+				continue
+			schedule.append((release_date.timestamp().__int__(), name, p["time"], p["url"] if "url" in p else None))
+		schedule.sort(key=lambda n: n[0])
+
+		with self.lock:
+			self.premieres = premiere_data["premieres"]
+			self.schedule = schedule
+			self.mtime = mtime
+			self.cached = None
+
+	def reload_if_changed(self):
+		now = time.time()
+		if now - self.last_reload_check < reload_check_interval:
+			return
+		self.last_reload_check = now
+
+		try:
+			mtime = os.stat(premiere_file).st_mtime
+		except OSError:
+			return
+		if mtime == self.mtime:
+			return
+
+		# a half-written file keeps the old schedule until the next check
+		try:
+			with open(premiere_file, "r") as file:
+				premiere_data = json.load(file)
+		except (OSError, ValueError) as e:
+			print(f"PREMIERE RELOAD ERROR: {e}")
+			return
+		if "premieres" not in premiere_data or premiere_data["premieres"] is None:
+			return
+
+		self.load(premiere_data, mtime)
+		print("Reloaded premieres")
+
+	# returns (package, etag, seconds clients may cache it)
+	def get_response(self):
+		self.reload_if_changed()
+		now = time.time()
+
+		with self.lock:
+			cached = self.cached
+			if cached is None or (cached[2] is not None and now >= cached[2]):
+				res = []
+				expires = None
+				for release_timestamp, name, date, url in self.schedule:
+					prem = {
+						"release_timestamp": release_timestamp,
+						"name": name,
+						"date": date,
+					}
+
+					if release_timestamp <= now:
+						prem["url"] = url
+					elif expires is None:
+						expires = release_timestamp
+
+					res.append(prem)
+
+				package = {"data": res}
+				etag = hashlib.sha1(json.dumps(package, sort_keys=True).encode()).hexdigest()
+				cached = self.cached = (package, etag, expires)
+
+		package, etag, expires = cached
+		max_age = max_cache_age if expires is None else max(0, min(max_cache_age, int(expires - now)))
+		return package, etag, max_age
 
 	def get_all(self):
-		res = [] 
-		now = datetime.now()
-		for name in self.premieres:
-			p = self.premieres[name]
-			time = p["time"]
-			release_date = datetime.strptime(time, '%Y-%m-%d %I:%M%p')
-
-			delta = (release_date - now).total_seconds()
-
-			prem =  {
-				"release_timestamp": (release_date.timestamp()).__int__(),
-				"name": name,
-				"date": time,
-			}
-			
-			if delta <= 0:
-				prem["url"] = p["url"]
-
-			res.append(prem);
-
-		return {"data": res};
+		package, _, _ = self.get_response()
+		return package
 	
 	def get_premiere(self, name) -> dict:
 		premiere = self.premieres[name]
 
-	pass
\ No newline at end of file
+	pass
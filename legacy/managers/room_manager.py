@@ -4,28 +4,39 @@ from pathlib import Path
 
 user_max_idle_time = 99999
 
-from tools import load_json, write_json
+from tools import load_json, write_json, TimingWheel
 
 
 class RoomManager:
-    def __init__(self):
+    def __init__(self, room_defs = None):
         Path("data/rooms").mkdir(parents=True, exist_ok=True)
 
         self.user_def_vals = ["x", "y", "costume", "sx"]
 
-        with open("./init/rooms.json", "r") as file:
-            defs = json.load(file)["defs"]
-            for room in defs:
-                room_file = open(f"data/rooms/{room['room_id']}.json", "w")
-                base_room_data = {
-                    "room_id": room["room_id"],
-                    "room_name": room["room_name"],
-                    "maps": room["maps"],
-                    "users": {},
-                }
-                room_file.write(json.dumps(base_room_data, indent=4))
+        if room_defs is None:
+            with open("./init/rooms.json", "r") as file:
+                room_defs = [
+                    {"id": room["room_id"], "name": room["room_name"], "maps": room["maps"]}
+                    for room in json.load(file)["defs"]
+                ]
+
+        # room_id -> room data; the JSON files are only written when a room changes
+        self.rooms = {}
+        # (room_id, user_name) -> idle deadline
+        self.expiry = TimingWheel()
+
+        for room in room_defs:
+            room_id = str(room["id"])
+            self.rooms[room_id] = {
+                "room_id": room["id"],
+                "room_name": room["name"],
+                "maps": room["maps"] if "maps" in room else [],
+                "users": {},
+            }
+            self.set_room(room_id, self.rooms[room_id])
 
     def write_user_to_room(self, room_id, user) -> bool:
+        room_id = str(room_id)
         room_data = self.get_room(room_id)
 
         user_name = user["name"]
@@ -37,9 +48,12 @@ class RoomManager:
             for val in self.user_def_vals:
                 if val in user:
                     room_data["users"][user_name][val] = user[val]
+            room_data["users"][user_name]["timestamp"] = user["timestamp"]
         else:
             room_data["users"][user_name] = user
 
+        self.expiry.touch((room_id, user_name), user["timestamp"] + user_max_idle_time)
+
         request_for_more_info = False
         for val in self.user_def_vals:
             if val not in room_data["users"][user_name]:
@@ -50,32 +64,37 @@ class RoomManager:
         return request_for_more_info
 
     def set_room(self, room_id, room_data):
+        self.rooms[str(room_id)] = room_data
         write_json(f"data/rooms/{room_id}.json", room_data)
 
     def get_room(self, room_id) -> dict:
-        return load_json(f"data/rooms/{room_id}.json")
+        room_id = str(room_id)
+        if room_id not in self.rooms:
+            room_data = load_json(f"data/rooms/{room_id}.json")
+            if room_data is None:
+                return None
+            self.rooms[room_id] = room_data
+        return self.rooms[room_id]
 
     def get_room_users(self, room_id) -> dict:
         room = self.get_room(room_id)
         return room["users"]
 
+    # only the users whose deadline passed are visited, and only rooms that lost
+    # someone are written back
     def cleanup_old_users(self):
-        for room_id in ["1", "2", "3"]:
-            room_data = self.get_room(room_id)
-
-            current_timestamp = time.time()
-
-            shitlist = []
+        changed = set()
+        shitlist = []
 
-            for user_name in room_data["users"]:
-                diff = current_timestamp - room_data["users"][user_name]["timestamp"]
-                if diff >= user_max_idle_time:
-                    shitlist.append(user_name)
-
-            if len(shitlist) > 0:
-                print(shitlist)
-
-            for user_name in shitlist:
+        for room_id, user_name in self.expiry.expire(time.time()):
+            room_data = self.rooms.get(room_id)
+            if room_data is not None and user_name in room_data["users"]:
                 del room_data["users"][user_name]
+                shitlist.append(user_name)
+                changed.add(room_id)
+
+        if len(shitlist) > 0:
+            print(shitlist)
 
-            write_json(f"data/rooms/{room_id}.json", room_data)
+        for room_id in changed:
+            write_json(f"data/rooms/{room_id}.json", self.rooms[room_id])
@@ -0,0 +1,68 @@
+import gzip
+import json
+import threading
+
+# Pre-serialized room responses. The body for a room is encoded (and gzipped) once
+# per room version and tick rate, and the same bytes go to every poller until the
+# room changes.
+
+gzip_level = 5
+
+
+class Snapshot:
+    # kind names the format, so the JSON and binary bodies of one version never share an ETag
+    def __init__(self, kind, tag, body):
+        self.tag = tag
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=gzip_level)
+        self.etag = "-".join(str(t) for t in (kind,) + tuple(tag))
+        self.gzip_etag = self.etag + "-gzip"
+
+
+class SnapshotManager:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (room_id, kind) -> latest Snapshot
+        self.snapshots = {}
+        # (room_id, kind) -> lock held while that snapshot is rebuilt
+        self.build_locks = {}
+        self.hits = 0
+        self.builds = 0
+
+    def get_build_lock(self, key) -> threading.Lock:
+        with self.lock:
+            lock = self.build_locks.get(key)
+            if lock is None:
+                lock = self.build_locks[key] = threading.Lock()
+            return lock
+
+    # tag identifies the content (room version, tick rate...); build() returns the
+    # package dict, or bytes that are already encoded
+    def get(self, key, tag, build) -> Snapshot:
+        snapshot = self.snapshots.get(key)
+        if snapshot is not None and snapshot.tag == tag:
+            self.hits += 1
+            return snapshot
+
+        # only one poller encodes a new version, the rest wait for its bytes
+        with self.get_build_lock(key):
+            snapshot = self.snapshots.get(key)
+            if snapshot is not None and snapshot.tag == tag:
+                self.hits += 1
+                return snapshot
+
+            body = build()
+            if not isinstance(body, bytes):
+                body = json.dumps(body, separators=(",", ":")).encode()
+            snapshot = Snapshot(key[-1], tag, body)
+            self.snapshots[key] = snapshot
+            self.builds += 1
+            return snapshot
+
+    def stats(self) -> dict:
+        return {
+            "snapshots": len(self.snapshots),
+            "hits": self.hits,
+            "builds": self.builds,
+            "bytes": sum(len(s.body) + len(s.gzip_body) for s in list(self.snapshots.values())),
+        }
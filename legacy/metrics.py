@@ -0,0 +1,271 @@
+import bisect
+import inspect
+import threading
+import time
+
+# Small in-process metrics registry, rendered in the Prometheus text format at
+# /metrics. Recording is a dict lookup and an increment under a per-metric lock,
+# so it stays on in production.
+
+# request and query latencies in seconds
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names, values) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f"{name}=\"{escape_label(value)}\"" for name, value in zip(names, values)) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value != value:
+        return "NaN"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    # fn, when given, reads totals that are already counted elsewhere, the same
+    # way as Gauge's; they must only ever go up
+    def __init__(self, name, help, labels = (), fn = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self.lock = threading.Lock()
+        # label values -> count
+        self.values = {}
+
+    def inc(self, *label_values, amount = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                values = self.fn()
+            except Exception as e:
+                print(f"METRICS COUNTER ERROR @ {self.name}: {e}")
+                return
+            items = values.items() if isinstance(values, dict) else [((), values)]
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        for label_values, value in items:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Gauge:
+    kind = "gauge"
+
+    # fn, when given, is called at scrape time and returns {label values tuple: value}
+    # (or a plain number when the gauge has no labels)
+    def __init__(self, name, help, labels = (), fn = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                values = self.fn()
+            except Exception as e:
+                print(f"METRICS GAUGE ERROR @ {self.name}: {e}")
+                return
+            items = values.items() if isinstance(values, dict) else [((), values)]
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        for label_values, value in items:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [per bucket counts + overflow, sum, count]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self.values.items()]
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",), label_values + (format_value(float(bound)),))
+                yield self.name + "_bucket", labels, cumulative
+            labels = format_labels(self.labels, label_values)
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels = (), fn = None) -> Counter:
+        return self.register(Counter(name, help, labels, fn))
+
+    def gauge(self, name, help, labels = (), fn = None) -> Gauge:
+        return self.register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, labels = (), buckets = default_buckets) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# merges the /metrics output of several processes, {key: text}, into one page,
+# adding label="key" to each of their samples. Every family keeps one HELP and
+# TYPE line with all of its samples under it.
+def merge(texts, label) -> str:
+    families = {}
+    for key, text in texts.items():
+        extra = f"{label}=\"{escape_label(key)}\""
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                family = families.setdefault(line.split(" ", 3)[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+                continue
+            if line == "" or line.startswith("#"):
+                continue
+
+            brace = line.find("{")
+            space = line.find(" ")
+            if brace != -1 and brace < space:
+                separator = "" if line[brace + 1] == "}" else ","
+                sample = line[:brace + 1] + extra + separator + line[brace + 1:]
+            else:
+                sample = line[:space] + "{" + extra + "}" + line[space:]
+
+            if family is None:
+                family = families.setdefault(line[:space if brace == -1 else min(brace, space)], ([], []))
+            family[1].append(sample)
+
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n" if len(lines) > 0 else ""
+
+
+# number of rows in a db method's result: lists and dicts by length, tuples by
+# their first element (users, removed, ... / events, cursor)
+def count_rows(result) -> int:
+    if isinstance(result, tuple):
+        result = result[0] if len(result) > 0 else None
+    if isinstance(result, (list, dict, set)):
+        return len(result)
+    return 1 if result is not None else 0
+
+
+# replaces every public method of obj with one that records its duration and the
+# rows it returned. Generator methods are timed per chunk, each chunk counting as
+# one call, so a slow reader doesn't show up as a slow query.
+def instrument(obj, prefix, skip = ()):
+    calls = registry.histogram(f"{prefix}_call_duration_seconds", f"Time spent in {prefix} methods", ["method"])
+    rows = registry.counter(f"{prefix}_rows_total", f"Rows returned by {prefix} methods", ["method"])
+    errors = registry.counter(f"{prefix}_errors_total", f"Exceptions raised by {prefix} methods", ["method"])
+
+    def wrap(name, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                errors.inc(name)
+                raise
+            finally:
+                calls.observe(time.perf_counter() - start, name)
+            rows.inc(name, amount=count_rows(result))
+            return result
+        wrapper.__name__ = name
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def wrap_generator(name, method):
+        def wrapper(*args, **kwargs):
+            chunks = method(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                except Exception:
+                    errors.inc(name)
+                    calls.observe(time.perf_counter() - start, name)
+                    raise
+                calls.observe(time.perf_counter() - start, name)
+                rows.inc(name, amount=count_rows(chunk))
+                yield chunk
+        wrapper.__name__ = name
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    for name in dir(type(obj)):
+        if name.startswith("_") or name in skip:
+            continue
+        method = getattr(obj, name)
+        if inspect.isgeneratorfunction(method):
+            setattr(obj, name, wrap_generator(name, method))
+        elif callable(method):
+            setattr(obj, name, wrap(name, method))
@@ -0,0 +1,168 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import deque
+
+# Live diagnosis, switched on and off at runtime through the /admin routes:
+#
+#   SamplingProfiler  samples every thread's stack a few hundred times a second
+#                     for N seconds and reports them as collapsed stacks, the
+#                     input flamegraph.pl and speedscope take
+#   SlowLog           while on, runs each request under cProfile and keeps the
+#                     profile of the ones slower than a threshold
+#
+# Nothing here costs anything while it is off.
+
+max_stack_depth = 128
+
+# innermost frames in these files mean the thread is parked, not working
+idle_files = ("threading.py", "selectors.py", "socket.py", "socketserver.py", "queue.py", "ssl.py")
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# "Thread-12 (process_request_thread)" and "Thread-13 (...)" are the same kind of thread
+def thread_label(name) -> str:
+    return re.sub(r"-\d+", "", name).replace(";", ",")
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        # collapsed stack -> samples
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self.until = None
+        self.interval = None
+        self.include_idle = False
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    # returns False if a run is already going
+    def start(self, seconds, interval_ms = 5, include_idle = False) -> bool:
+        with self.lock:
+            if self.running():
+                return False
+            self.stacks = {}
+            self.samples = 0
+            self.started = time.time()
+            self.until = self.started + seconds
+            self.interval = interval_ms / 1000
+            self.include_idle = include_idle
+            self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.until = time.time()
+
+    def run(self):
+        me = threading.get_ident()
+        while time.time() < self.until:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if not self.include_idle and os.path.basename(frame.f_code.co_filename) in idle_files:
+                    continue
+
+                labels = []
+                while frame is not None and len(labels) < max_stack_depth:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                labels.append(thread_label(names.get(ident, "unknown")))
+                stack = ";".join(reversed(labels))
+
+                with self.lock:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    # one "frame;frame;frame count" line per distinct stack
+    def collapsed(self) -> str:
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running(),
+            "started": self.started,
+            "until": self.until,
+            "interval_ms": self.interval * 1000 if self.interval is not None else None,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+        }
+
+
+class SlowLog:
+    def __init__(self, threshold_ms = 250, max_entries = 50, top_functions = 40):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.threshold_ms = threshold_ms
+        self.top_functions = top_functions
+        self.entries = deque(maxlen=max_entries)
+        self.profiled = 0
+
+    def configure(self, enabled = None, threshold_ms = None):
+        if threshold_ms is not None:
+            self.threshold_ms = threshold_ms
+        if enabled is not None:
+            self.enabled = enabled
+
+    # a running cProfile for the request, or None while off
+    def begin(self):
+        if not self.enabled:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler already owns this thread
+            return None
+        return profile
+
+    def end(self, profile, elapsed_ms, method, path, status):
+        profile.disable()
+        self.profiled += 1
+        if elapsed_ms < self.threshold_ms:
+            return
+
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(self.top_functions)
+        with self.lock:
+            self.entries.append({
+                "time": time.time(),
+                "method": method,
+                "path": path,
+                "status": status,
+                "ms": elapsed_ms,
+                "profile": out.getvalue(),
+            })
+
+    def get_entries(self) -> list:
+        with self.lock:
+            return list(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": self.threshold_ms,
+            "profiled": self.profiled,
+            "entries": len(self.entries),
+        }
@@ -0,0 +1,266 @@
+# Front router for the sharded mode (see sharding.py). Starts one server.py per
+# shard and forwards each request to its owner:
+#
+#   /rooms/<room_id>/...   the shard that owns the room; a user who moves to a
+#                          room on another shard is dropped from their old one
+#   /saves/get, /saves/post the saves shard, which serves no rooms
+#   /users/<username>      every shard; the most recently seen record wins
+#   /log/stats, /log/dump* every shard, tagged with the shard's name
+#   /metrics               the router's own metrics plus every shard's (the saves
+#                          shard's too), with a shard label
+#   everything else        the first shard
+#
+#   SERVER_PORT=5000 python3 router.py
+#
+# Set "shard_spawn": false in config.json to route to shards started some other way.
+# Needs requests as well as Flask: pip install requests
+
+from flask import Flask, request, jsonify
+import atexit
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+
+from tools import load_json
+import metrics
+import sharding
+
+config = load_json("config.json")
+
+shards = sharding.get_shards(config)
+owners = sharding.room_owners(shards)
+saves_shard = sharding.get_saves_shard(config)
+
+# how long a forwarded request may take; long-polls are held for up to 30s
+upstream_timeout = config["router_timeout"] if "router_timeout" in config else 60
+shard_restart_interval = 1
+
+# headers that describe a single hop and are not passed on
+hop_headers = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers", "transfer-encoding", "upgrade", "host"}
+# the router's own server sets these on the answer
+own_headers = {"server", "date"}
+
+app = Flask(__name__)
+
+sessions = {shard["name"]: requests.Session() for shard in shards + [saves_shard]}
+
+forwarded = metrics.registry.counter("tankmas_router_requests_total", "Requests forwarded to each shard", ["shard", "status"])
+upstream_latency = metrics.registry.histogram("tankmas_router_upstream_seconds", "Time until a shard answered", ["shard"])
+# username -> (shard name, room id) of the last room they posted to
+user_rooms = {}
+user_rooms_lock = threading.Lock()
+
+shard_up = metrics.registry.gauge("tankmas_router_shard_up", "Whether the shard's last scrape succeeded", ["shard"])
+
+
+def shard_url(shard, path) -> str:
+    return f"http://{shard['host']}:{shard['port']}{path}"
+
+
+def call_shard(shard, method, path, body = None, headers = None, stream = False):
+    start = time.perf_counter()
+    try:
+        response = sessions[shard["name"]].request(
+            method, shard_url(shard, path), data=body, headers=headers, stream=stream,
+            allow_redirects=False, timeout=upstream_timeout,
+        )
+    except requests.RequestException as e:
+        print(f"ROUTER ERROR @ {shard['name']}: {e}")
+        forwarded.inc(shard["name"], 502)
+        return None
+    upstream_latency.observe(time.perf_counter() - start, shard["name"])
+    forwarded.inc(shard["name"], response.status_code)
+    return response
+
+
+def unavailable(shard):
+    return jsonify({"data": {}, "shard": shard["name"]}), 502
+
+
+# passes the request on as is and streams the shard's answer back untouched
+def forward(shard):
+    path = request.full_path if request.query_string else request.path
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in hop_headers}
+    # the body is passed on undecoded, so the session mustn't ask for gzip on the client's behalf
+    if "Accept-Encoding" not in request.headers:
+        headers["Accept-Encoding"] = "identity"
+    upstream = call_shard(shard, request.method, path, request.get_data(), headers, stream=True)
+    if upstream is None:
+        return unavailable(shard)
+
+    response = app.response_class(
+        upstream.raw.stream(64 * 1024, decode_content=False),
+        status=upstream.status_code,
+        headers=[(k, v) for k, v in upstream.headers.items() if k.lower() not in hop_headers and k.lower() not in own_headers],
+    )
+    response.call_on_close(upstream.close)
+    return response
+
+
+@app.route("/rooms/<room_id>", methods=["GET"])
+@app.route("/rooms/<room_id>/<path:rest>", methods=["GET", "POST"])
+def room_route(room_id, rest = None):
+    try:
+        shard = owners.get(int(room_id))
+    except ValueError:
+        shard = None
+    if shard is None:
+        return jsonify({"data": {}}), 404
+
+    response = forward(shard)
+    if request.method == "POST" and rest in ("users", "sync") and response.status_code == 200:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and "name" in body:
+            moved(str(body["name"]), shard, int(room_id))
+    return response
+
+
+# the shard a user left never hears about it otherwise, and would keep listing
+# them until they went idle
+def moved(username, shard, room_id):
+    with user_rooms_lock:
+        previous = user_rooms.get(username)
+        user_rooms[username] = (shard["name"], room_id)
+    if previous is None or previous[0] == shard["name"]:
+        return
+
+    old = sharding.find_shard(shards, previous[0])
+    upstream = call_shard(old, "DELETE", f"/rooms/{previous[1]}/users/{quote(username, safe='')}")
+    if upstream is not None:
+        upstream.close()
+
+
+@app.route("/saves/<action>", methods=["POST"])
+def save_route(action):
+    return forward(saves_shard)
+
+
+# a user is only present on the shard of the room they are in, so ask them all
+@app.route("/users/<username>", methods=["GET"])
+def user_route(username):
+    package = {"tick_rate": None, "data": None}
+    for shard in shards:
+        upstream = call_shard(shard, "GET", request.path)
+        if upstream is None or upstream.status_code != 200:
+            continue
+        answer = upstream.json()
+        if package["tick_rate"] is None:
+            package["tick_rate"] = answer["tick_rate"]
+        user = answer["data"]
+        if user is not None and (package["data"] is None or user["timestamp"] > package["data"]["timestamp"]):
+            package["data"] = user
+    return jsonify(package), 200
+
+
+@app.route("/log/stats", methods=["GET"])
+def stats_route():
+    data = {}
+    for shard in shards:
+        upstream = call_shard(shard, "GET", "/log/stats")
+        data[shard["name"]] = upstream.json() if upstream is not None and upstream.status_code == 200 else None
+    return jsonify(data), 200
+
+
+# ?shard= dumps one shard, and is the only way to page with ?after_id=, since ids
+# are per shard; otherwise every shard is dumped in turn
+@app.route("/log/dump", methods=["GET"])
+@app.route("/log/dump/<table>", methods=["GET"])
+def dump_route(table = None):
+    name = request.args.get("shard")
+    if name is not None:
+        try:
+            return forward(sharding.find_shard(shards, name))
+        except ValueError:
+            return jsonify({"data": {}}), 404
+
+    path = request.full_path if request.query_string else request.path
+
+    def generate():
+        for shard in shards:
+            upstream = call_shard(shard, "GET", path, stream=True)
+            if upstream is None:
+                continue
+            try:
+                for line in upstream.iter_lines():
+                    if len(line) > 0:
+                        row = json.loads(line)
+                        row["shard"] = shard["name"]
+                        yield json.dumps(row, separators=(",", ":")) + "\n"
+            finally:
+                upstream.close()
+
+    return app.response_class(generate(), mimetype="application/x-ndjson")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    texts = {}
+    for shard in shards + [saves_shard]:
+        upstream = call_shard(shard, "GET", "/metrics")
+        up = upstream is not None and upstream.status_code == 200
+        shard_up.set(1 if up else 0, shard["name"])
+        if up:
+            texts[shard["name"]] = upstream.text
+    body = metrics.registry.render() + metrics.merge(texts, "shard")
+    return app.response_class(body, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/", defaults={"path": ""}, methods=["GET", "POST"])
+@app.route("/<path:path>", methods=["GET", "POST"])
+def default_route(path):
+    return forward(shards[0])
+
+
+processes = {}
+stopping = False
+
+def start_shard(shard):
+    env = dict(os.environ, TANKMAS_SHARD=shard["name"], SERVER_PORT=str(shard["port"]))
+    env.pop("USE_HTTPS", None)
+    processes[shard["name"]] = subprocess.Popen([sys.executable, "server.py"], env=env)
+
+# restarts shards that died, so one crashed room doesn't stay down
+def supervise_shards():
+    while not stopping:
+        for shard in shards + [saves_shard]:
+            process = processes[shard["name"]]
+            if process.poll() is not None:
+                print(f"SHARD EXITED @ {shard['name']}: {process.returncode}, restarting")
+                start_shard(shard)
+        time.sleep(shard_restart_interval)
+
+def stop_shards():
+    global stopping
+    stopping = True
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+if config["shard_spawn"] if "shard_spawn" in config else True:
+    for shard in shards + [saves_shard]:
+        start_shard(shard)
+    atexit.register(stop_shards)
+    threading.Thread(target=supervise_shards, daemon=True).start()
+
+if __name__ == "__main__":
+    # exit through atexit on a plain kill too, so the shards go down with the router
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    use_https = os.getenv("USE_HTTPS") is not None
+
+    ssl_context = None
+    if use_https:
+        ssl_context = ("cert/privkey.key", "cert/cert.crt")
+
+    app.run(host="0.0.0.0", port=os.getenv("SERVER_PORT"), ssl_context=ssl_context, threaded=True)
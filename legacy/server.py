@@ -1,14 +1,23 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, g, stream_with_context
 from threading import Lock
 import threading
+import atexit
+import hmac
+import json
+import math
 import os
 import time
 
 from tools import load_json
+import metrics
+import profiler
+import sharding
+import wire
 
-from managers import HitManager, RoomManager, EventManager,PremiereManager, SaveManager
+from managers import HitManager, RoomManager, EventManager,PremiereManager, SaveManager, SnapshotManager
 
 from db.tankmasdb import TankmasDb;
+from db.event_writer import EventQueueFull
 
 # from queue import Queue
 # from threading import Thread
@@ -18,25 +27,104 @@ from db.tankmasdb import TankmasDb;
 
 config = load_json("config.json")
 
+# started by router.py as one shard: only its rooms, from its own data folder
+shard_name = os.getenv("TANKMAS_SHARD")
+if shard_name is not None:
+    config = sharding.shard_config(config, shard_name)
+
 db = TankmasDb(config)
 
-rooms = RoomManager()
+rooms = RoomManager(config["rooms"])
 events = EventManager()
 saves = SaveManager()
-hits = HitManager()
+hits = HitManager(config, db.shared)
+snapshots = SnapshotManager()
 
 premieres = PremiereManager()
 
 app = Flask(__name__)
 
+# hand the request's pooled connection back
+@app.teardown_appcontext
+def close_connection(exception):
+    db.close()
+
+# every db call records its duration and the rows it returned; the per request
+# connection plumbing is left out
+metrics.instrument(db, "tankmas_db", skip=("get_db", "close"))
+
 with app.app_context():
     db.init(config, app)
 
+request_count = metrics.registry.counter("tankmas_requests_total", "Requests handled", ["route", "method", "status"])
+request_errors = metrics.registry.counter("tankmas_request_errors_total", "Requests answered with a 4xx or 5xx", ["route", "method"])
+request_latency = metrics.registry.histogram("tankmas_request_duration_seconds", "Request handler latency", ["route", "method"])
+background_lag = metrics.registry.gauge("tankmas_background_lag_seconds", "How late the last background tick started")
+background_duration = metrics.registry.histogram("tankmas_background_duration_seconds", "Background tick duration")
+metrics.registry.gauge("tankmas_room_users", "Users currently in each room", ["room_id"],
+    lambda: {(room_id,): count for room_id, count in db.state.get_room_sizes().items()})
+metrics.registry.gauge("tankmas_events_rows", "Rows in the events table, refreshed by the background loop",
+    fn=lambda: db.event_count if db.event_count is not None else float("nan"))
+metrics.registry.gauge("tankmas_event_queue_depth", "Events waiting for the group commit",
+    fn=lambda: db.event_writer.stats()["queue_depth"])
+metrics.registry.counter("tankmas_user_updates_total", "Position updates: received, unchanged (heartbeat only), coalesced into a pending write, and rows written",
+    ["outcome"], lambda: {(outcome,): value for outcome, value in db.user_stats().items() if outcome in ("updates", "unchanged", "coalesced", "written")})
+metrics.registry.gauge("tankmas_db_connections_in_use", "Pooled connections borrowed by requests",
+    fn=lambda: db.pool.stats()["in_use"])
+
+# the /admin routes answer only to "Authorization: Bearer <ADMIN_TOKEN>", and
+# don't exist when ADMIN_TOKEN isn't set
+admin_token = os.getenv("ADMIN_TOKEN")
+sampler = profiler.SamplingProfiler()
+slow_log = profiler.SlowLog(config["slow_log_threshold_ms"] if "slow_log_threshold_ms" in config else 250)
+profile_max_seconds = 300
+
+# every request feeds its handler latency into the tick rate controller and the metrics
+@app.before_request
+def start_request_timer():
+    g.request_profile = slow_log.begin()
+    g.request_start = time.perf_counter()
+
+# unknown rooms are turned away before any per-room state (load buckets, room
+# versions, snapshots) gets created for them
+@app.before_request
+def check_room():
+    if request.view_args is None or "room_id" not in request.view_args:
+        return None
+    try:
+        room_id = int(request.view_args["room_id"])
+    except ValueError:
+        room_id = None
+    if room_id not in db.room_infos:
+        return jsonify({"tick_rate": hits.get_tick_rate(), "data": {}}), 404
+    g.room_id = room_id
+
+@app.after_request
+def record_request_load(response):
+    if "request_start" in g:
+        elapsed = time.perf_counter() - g.request_start
+        room_id = g.room_id if "room_id" in g else None
+        # a parked long-poll isn't load, it would only inflate the p95
+        if request.endpoint != "wait_room":
+            hits.record(room_id, elapsed * 1000)
+
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        request_count.inc(route, request.method, response.status_code)
+        request_latency.observe(elapsed, route, request.method)
+        if response.status_code >= 400:
+            request_errors.inc(route, request.method)
+
+        if g.request_profile is not None:
+            slow_log.end(g.request_profile, elapsed * 1000, request.method, request.full_path, response.status_code)
+    return response
+
 from flask_cors import CORS
-cors = CORS(app) # allow CORS for all domains on all routes.
+cors = CORS(app, expose_headers=["ETag"]) # allow CORS for all domains on all routes.
 app.config['CORS_HEADERS'] = 'Content-Type'
 
 server_background_update_interval = 1
+event_ack_timeout = 2
+long_poll_max_timeout = 30
 
 # events.post_event("tankman", "murder", {"yea": 0})
 # print(events.get_events_since("tankman", time.time()))
@@ -46,6 +134,34 @@ server_background_update_interval = 1
 # rooms_lock = Lock()
 
 
+# Numbers from a request body must be numbers; numeric strings are still taken as
+# they always were. Returns one value per field (None when it's missing), or None
+# when one of them isn't a finite number, or with integer, a whole one.
+def number_args(body, fields, integer = False):
+    values = []
+    for field in fields:
+        value = body[field] if field in body else None
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                return None
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value)):
+            return None
+        if integer and value is not None:
+            if value != int(value):
+                return None
+            value = int(value)
+        values.append(value)
+    return tuple(values)
+
+# (x, y, sx), or None when one of them can't be a position
+def position_args(body):
+    return number_args(body, ("x", "y", "sx"))
+
+def bad_args(room_id):
+    return jsonify({"tick_rate": hits.get_tick_rate(room_id), "data": {}}), 400
+
 # Endpoint to join/update position in a room
 @app.route("/rooms/<room_id>/users", methods=["POST"])
 def update_room(room_id) -> dict:
@@ -53,135 +169,398 @@ def update_room(room_id) -> dict:
     body = request.json
     
     username = body["name"] if "name" in body else None
-    x = body["x"] if "x" in body else None
-    y = body["y"] if "y" in body else None
-    sx = body["sx"] if "sx" in body else None
+    position = position_args(body)
+    if position is None:
+        return bad_args(room_id)
+    x, y, sx = position
     costume = body["costume"] if "costume" in body else None
-    
-    hits.hit()
+    map_name = body["map"] if "map" in body else None
     
     if username is None:
         return jsonify({
-            "tick_rate": hits.get_tick_rate(),
+            "tick_rate": hits.get_tick_rate(room_id),
             "data": {}
         })
 
-    request_for_more_info = db.upsert_user(username, room_id, x, y, sx, costume)
+    request_for_more_info = db.upsert_user(username, room_id, x, y, sx, costume, map_name=map_name)
     
     package = {
-        "tick_rate": hits.get_tick_rate(),
+        "tick_rate": hits.get_tick_rate(room_id),
         "data": {"request_for_more_info": request_for_more_info},
     }
 
     return jsonify(package), 200
 
+# Drops a user from the room at once. The router calls this when a user moves to
+# a room on another shard, so this shard doesn't keep them until they go idle.
+@app.route("/rooms/<room_id>/users/<username>", methods=["DELETE"])
+def leave_room(room_id, username) -> dict:
+    removed = db.remove_user(username, room_id)
+    return jsonify({"data": {"removed": removed}}), 200
+
+# One round trip per tick: applies the position update and outgoing events, then
+# returns the room delta since "version" and the events after "cursor". With a
+# "radius" the delta only covers the users near the player's own position.
+@app.route("/rooms/<room_id>/sync", methods=["POST"])
+def sync_room(room_id) -> dict:
+    body = request.json
+
+    username = body["name"] if "name" in body else None
+    position = position_args(body)
+    counters = number_args(body, ("version", "cursor"), integer=True)
+    radius = number_args(body, ("radius",))
+    if position is None or counters is None or radius is None or (radius[0] is not None and radius[0] < 0):
+        return bad_args(room_id)
+    x, y, sx = position
+    since, cursor = counters
+    radius = radius[0]
+    costume = body["costume"] if "costume" in body else None
+    map_name = body["map"] if "map" in body else None
+    outgoing = body["events"] if "events" in body else []
+
+    if username is None:
+        return jsonify({
+            "tick_rate": hits.get_tick_rate(room_id),
+            "data": {}
+        })
+
+    request_for_more_info = db.upsert_user(username, room_id, x, y, sx, costume, map_name=map_name)
+
+    view = None
+    if radius is not None:
+        user = db.get_user(username)
+        if user is not None and user["x"] is not None and user["y"] is not None:
+            view = {"map": user["map"], "x": user["x"], "y": user["y"], "radius": radius, "username": username}
+
+    rejected_events = 0
+    for event in outgoing:
+        if "type" not in event:
+            continue
+        try:
+            db.post_event(username, event["type"], event["data"] if "data" in event else None, room_id)
+        except EventQueueFull:
+            rejected_events += 1
+
+    users, removed, version, full = db.get_room_changes(room_id, since if since is not None else -1, view=view)
+    events_array, cursor = db.get_new_events(username, room_id, cursor)
+
+    package = {
+        "tick_rate": hits.get_tick_rate(room_id),
+        "data": {
+            "request_for_more_info": request_for_more_info,
+            "users": users,
+            "removed": removed,
+            "version": version,
+            "full": full,
+            "events": events_array,
+            "cursor": cursor,
+            "rejected_events": rejected_events,
+        },
+    }
+
+    return jsonify(package), 200
+
+# The dumps stream one JSON object per line. Pass the id of the last line as
+# ?after_id= to continue, and narrow them with ?limit=, ?room_id=, and ?since= /
+# ?until= (unix times).
+def dump_args() -> dict:
+    return {
+        "after_id": request.args.get("after_id", 0, type=int),
+        "limit": request.args.get("limit", type=int),
+        "room_id": request.args.get("room_id", type=int),
+        "since": request.args.get("since", type=float),
+        "until": request.args.get("until", type=float),
+    }
+
+def ndjson_response(chunks):
+    def generate():
+        for rows in chunks:
+            yield "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+
+    # the request's pooled connection stays checked out until the stream ends
+    return app.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+# users then events, each line tagged with the table it came from. The two tables
+# have their own ids, so this one pages with ?users_after_id= and
+# ?events_after_id=, and ?limit= applies to each table.
 @app.route("/log/dump", methods=["GET"])
 def log_dump() -> dict:
-    data = db.dump_info()
-    return jsonify(data), 200
+    args = dump_args()
+    if "after_id" in request.args:
+        return jsonify({"data": {}}), 400
+    users_args = dict(args, after_id=request.args.get("users_after_id", 0, type=int))
+    events_args = dict(args, after_id=request.args.get("events_after_id", 0, type=int))
+
+    def chunks():
+        for rows in db.stream_users(**users_args):
+            yield [dict(row, table="users") for row in rows]
+        for rows in db.stream_events(**events_args):
+            yield [dict(row, table="events") for row in rows]
+
+    return ndjson_response(chunks())
 
 @app.route("/log/dump/users", methods=["GET"])
 def log_users() -> dict:
-    data = db.get_users()
+    return ndjson_response(db.stream_users(**dump_args()))
+
+@app.route("/log/stats", methods=["GET"])
+def log_stats() -> dict:
+    data = db.stats()
+    data["load"] = hits.stats()
+    data["snapshots"] = snapshots.stats()
+    data["shard"] = shard_name
     return jsonify(data), 200
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return app.response_class(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/log/dump/events", methods=["GET"])
 def log_events() -> dict:
-    data = db.get_events()
-    return jsonify(data), 200
+    return ndjson_response(db.stream_events(**dump_args()))
 
 @app.route("/users/<username>", methods=["GET"])
 def get_user(username) -> dict:
     user = db.get_user(username)
 
-    hits.hit()
-
     package = {"tick_rate": hits.get_tick_rate(), "data": user}
     return jsonify(package), 200
 
+# clients opt into the binary room format through the Accept header
+def wants_wire() -> bool:
+    for mimetype, quality in request.accept_mimetypes:
+        if mimetype == wire.MIMETYPE and quality > 0:
+            return True
+    return False
+
+def wire_room(room_id, since, tick_rate, view = None) -> bytes:
+    users, removed, version, full = db.get_room_changes(room_id, since, field_versions=True, view=view)
+    return wire.encode_room(users, removed, version, tick_rate, full, since)
+
+# ?x=&y=&radius=[&map=] limits a room poll to the users near that point. ?name=
+# says whose position the point is, so deltas only resend everyone near after
+# that user moved.
+def get_view():
+    x = request.args.get("x", type=float)
+    y = request.args.get("y", type=float)
+    radius = request.args.get("radius", type=float)
+    if x is None or y is None or radius is None:
+        return None
+    view = {"map": request.args.get("map"), "x": x, "y": y, "radius": radius}
+    if "name" in request.args:
+        view["username"] = request.args["name"]
+    return view
+
+# serves a pre-encoded snapshot, gzipped when the client accepts it
+def snapshot_response(snapshot, mimetype = "application/json"):
+    gzipped = request.accept_encodings.quality("gzip") > 0
+    etag = snapshot.gzip_etag if gzipped else snapshot.etag
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif gzipped:
+        response = app.response_class(snapshot.gzip_body, mimetype=mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = app.response_class(snapshot.body, mimetype=mimetype)
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    response.set_etag(etag)
+    return response
+
 @app.route("/rooms/<room_id>", methods=["GET"])
 def get_room(room_id) -> dict:
-    room = db.get_room(room_id)
+    tick_rate = hits.get_tick_rate(room_id)
+    version = db.get_room_version(room_id)
+    view = get_view()
 
-    hits.hit()
+    # a view is specific to one poller, so it skips the shared snapshots
+    if view is not None:
+        if wants_wire():
+            return app.response_class(wire_room(room_id, -1, tick_rate, view), mimetype=wire.MIMETYPE)
+        return jsonify({"tick_rate": tick_rate, "data": db.get_room(room_id, view)}), 200
 
-    package = {"tick_rate": hits.get_tick_rate(), "data": room}
-    return jsonify(package), 200
+    # the binary format only carries the users, room info is static
+    if wants_wire():
+        snapshot = snapshots.get((g.room_id, "wire"), (version, tick_rate), lambda: wire_room(room_id, -1, tick_rate))
+        return snapshot_response(snapshot, wire.MIMETYPE)
+
+    def build():
+        room = db.get_room(room_id)
+        return {"tick_rate": tick_rate, "data": room}
 
+    return snapshot_response(snapshots.get((g.room_id, "room"), (version, tick_rate), build))
 
+
+# ?since=<version> returns only the users added, changed or removed after that version
 @app.route("/rooms/<room_id>/users", methods=["GET"])
 def get_room_users(room_id) -> dict:
-    room = db.get_room(room_id)
-    
-    users = room["users"] if room is not None and room["users"] is not None else {}
+    since = request.args.get("since", type=int)
+    view = get_view()
+
+    if wants_wire():
+        tick_rate = hits.get_tick_rate(room_id)
+        if since is not None or view is not None:
+            return app.response_class(wire_room(room_id, since if since is not None else -1, tick_rate, view), mimetype=wire.MIMETYPE)
+
+        version = db.get_room_version(room_id)
+        snapshot = snapshots.get((g.room_id, "wire"), (version, tick_rate), lambda: wire_room(room_id, -1, tick_rate))
+        return snapshot_response(snapshot, wire.MIMETYPE)
+
+    if since is not None:
+        users, removed, version, full = db.get_room_changes(room_id, since, view=view)
+        package = {
+            "tick_rate": hits.get_tick_rate(room_id),
+            "data": users,
+            "removed": removed,
+            "version": version,
+            "full": full,
+        }
+        return jsonify(package), 200
 
-    hits.hit()
+    tick_rate = hits.get_tick_rate(room_id)
+    version = db.get_room_version(room_id)
 
-    package = {"tick_rate": hits.get_tick_rate(), "data": users}
-    return jsonify(package), 200
+    if view is not None:
+        return jsonify({"tick_rate": tick_rate, "data": db.get_users(room_id, view), "version": version}), 200
+
+    def build():
+        room = db.get_room(room_id)
+        users = room["users"] if room is not None and room["users"] is not None else {}
+        return {"tick_rate": tick_rate, "data": users, "version": version}
+
+    return snapshot_response(snapshots.get((g.room_id, "users"), (version, tick_rate), build))
+
+
+# what a long-poller gets back: the user delta since "version" and the room's
+# events after "cursor" (or the username's tracked cursor)
+def room_updates(room_id, version, cursor, username, changed) -> dict:
+    users, removed, new_version, full = db.get_room_changes(room_id, version)
+
+    events_array = []
+    if cursor is not None or username is not None:
+        events_array, cursor = db.get_new_events(username, room_id, cursor)
+
+    return {
+        "tick_rate": hits.get_tick_rate(room_id),
+        "data": {
+            "changed": changed,
+            "users": users,
+            "removed": removed,
+            "version": new_version,
+            "full": full,
+            "events": events_array,
+            "cursor": cursor,
+        },
+    }
+
+def long_poll_args() -> dict:
+    return {
+        "version": request.args.get("version", -1, type=int),
+        "cursor": request.args.get("cursor", type=int),
+        "username": request.args.get("username"),
+        "timeout": max(0.0, min(request.args.get("timeout", long_poll_max_timeout, type=float), long_poll_max_timeout)),
+    }
+
+# Long-poll: parks until the room's version passes ?version= or it has events
+# after ?cursor=, or ?timeout= seconds pass. Holds a thread here; asgi.py serves
+# the same route without one.
+@app.route("/rooms/<room_id>/wait", methods=["GET"])
+def wait_room(room_id) -> dict:
+    args = long_poll_args()
+    changed = db.wait_for_room(room_id, args["version"], args["cursor"], args["timeout"])
+    return jsonify(room_updates(room_id, args["version"], args["cursor"], args["username"], changed)), 200
 
 
 @app.route("/rooms/<room_id>/events/post", methods=["POST"])
 def post_room_event(room_id) -> dict:
-    hits.hit()
-
     event = request.json
 
     username = event["username"] if "username" in event else None
     type = event["type"] if "type" in event else None
     data = event["data"] if "data" in event else None
 
-    package = {"tick_rate": hits.get_tick_rate()}
+    package = {"tick_rate": hits.get_tick_rate(room_id)}
     
     if username is None or type is None:
         return jsonify(package), 200
 
-    db.post_event(username, type, data, room_id)
+    try:
+        write = db.post_event(username, type, data, room_id)
+    except EventQueueFull:
+        return jsonify(package), 503
+
+    # clients that need to know the event was committed and synced can ask for an ack
+    if "ack" in event and event["ack"]:
+        package["durable"] = write.wait(event_ack_timeout)
 
     return jsonify(package), 200
 
 
 @app.route("/rooms/<room_id>/events/get", methods=["POST"])
 def get_room_events(room_id) -> dict:
-    hits.hit()
-
     username = request.json["username"] if "username" in request.json else None
+    since = number_args(request.json, ("since",), integer=True)
+    if since is None:
+        return bad_args(room_id)
+    since = since[0]
     events_array = []
+    cursor = since
     if username is not None: 
-        events_array = db.get_new_events(username, room_id)
+        events_array, cursor = db.get_new_events(username, room_id, since)
 
-    package = {"tick_rate": hits.get_tick_rate(), "data": {"events": events_array}}
+    package = {"tick_rate": hits.get_tick_rate(room_id), "data": {"events": events_array, "cursor": cursor}}
     return jsonify(package), 200
 
 
+background_next_run = None
+
 def server_background_tasks():
+    global background_next_run
+    start = time.time()
+    if background_next_run is not None:
+        background_lag.set(max(0.0, start - background_next_run))
+    background_next_run = start + server_background_update_interval
+
     hits.update_tick_rate()
-    threading.Timer(server_background_update_interval, server_background_tasks).start()
+    timer = threading.Timer(server_background_update_interval, server_background_tasks)
+    timer.name = "background-tasks"
+    timer.daemon = True
+    timer.start()
 
     db.process()
 
-    rooms.cleanup_old_users()
+    # the legacy room files are shared, so only the leader worker prunes them
+    if db.is_leader:
+        rooms.cleanup_old_users()
+    background_duration.observe(time.time() - start)
 
 @app.route("/saves/get", methods=["POST"])
 def fetch_save() -> dict:
-    hits.hit()
-
     event = request.json
     
     username = event["username"]
-    data = db.load_user_file(username)
+
+    # the save's hash is its ETag, so an unchanged save never leaves the db
+    save_hash = db.get_save_hash(username)
+    if save_hash is not None and request.if_none_match.contains(save_hash):
+        response = app.response_class(status=304)
+        response.set_etag(save_hash)
+        return response
+
+    data, save_hash = db.load_user_save(username)
 
     if data is None:
         data = "null"
 
     package = {"tick_rate": hits.get_tick_rate(), "data": data}
 
-    return jsonify(package), 200
+    response = jsonify(package)
+    if save_hash is not None:
+        response.set_etag(save_hash)
+    return response, 200
 
 @app.route("/saves/post", methods=["POST"])
 def post_save() -> dict:
-    hits.hit()
-
     event = request.json
 
     #saves.set_save(event["username"], event["data"])
@@ -193,11 +572,68 @@ def post_save() -> dict:
 
 @app.route("/premieres", methods=["GET"])
 def get_premieres() -> dict:
-    res = premieres.get_all()
-    return jsonify(res), 200
+    res, etag, max_age = premieres.get_response()
+
+    # the schedule only changes when a premiere goes live, so clients can cache it until then
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(res)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={max_age}"
+    return response
+
+def is_admin() -> bool:
+    if admin_token is None:
+        return False
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {admin_token}")
+
+# POST starts sampling every thread for ?seconds= (at most 300) every ?interval_ms=,
+# GET returns the collapsed stacks so far, DELETE stops early. Parked threads are
+# left out unless ?idle=1.
+@app.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+def admin_profile():
+    if not is_admin():
+        return jsonify({}), 404
+
+    if request.method == "POST":
+        seconds = max(0.0, min(request.args.get("seconds", 10, type=float), profile_max_seconds))
+        interval_ms = max(1.0, request.args.get("interval_ms", 5, type=float))
+        started = sampler.start(seconds, interval_ms, request.args.get("idle", 0, type=int) == 1)
+        return jsonify(sampler.stats()), 202 if started else 409
+
+    if request.method == "DELETE":
+        sampler.stop()
+        return jsonify(sampler.stats()), 200
+
+    response = app.response_class(sampler.collapsed(), mimetype="text/plain")
+    response.headers["X-Profile-Running"] = "1" if sampler.running() else "0"
+    return response
+
+# GET lists the slow requests with their profiles; POST {"enabled", "threshold_ms",
+# "clear"} switches the slow log on or off and tunes it
+@app.route("/admin/slowlog", methods=["GET", "POST"])
+def admin_slow_log():
+    if not is_admin():
+        return jsonify({}), 404
+
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        slow_log.configure(
+            enabled=bool(body["enabled"]) if "enabled" in body else None,
+            threshold_ms=float(body["threshold_ms"]) if "threshold_ms" in body else None,
+        )
+        if "clear" in body and body["clear"]:
+            slow_log.clear()
+        return jsonify(slow_log.stats()), 200
+
+    return jsonify({"slow_log": slow_log.stats(), "entries": slow_log.get_entries()}), 200
 
 server_background_tasks()
 
+# flush any dirty in-memory user state before the process goes away
+atexit.register(db.shutdown)
+
 @app.route("/", methods=["GET"])
 def index():
     return "Hello", 200
@@ -211,8 +647,4 @@ if __name__ == "__main__":
 
     app.run(host="0.0.0.0", port=os.getenv("SERVER_PORT"), ssl_context=ssl_context)
 
-
-@app.teardown_appcontext
-def close_connection(exception):
-    db.close()
     
\ No newline at end of file
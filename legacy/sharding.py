@@ -0,0 +1,87 @@
+import os
+
+# Sharded mode: router.py runs one server.py per shard on this machine. Each
+# shard serves only its own rooms, with its own process, state and database, and
+# the router forwards every request to the shard that owns it.
+#
+#   "shards": [
+#     {"name": "courtyard", "rooms": [1], "port": 5101},
+#     {"name": "bar", "rooms": [2, 3], "port": 5102}
+#   ]
+#
+# Without "shards" every room gets a shard of its own, on the ports after
+# shard_base_port.
+#
+# Saves don't belong to a room, so they stay in one place: a "saves" shard that
+# serves no rooms and keeps the top level data folder, where data/tankmas.db
+# already holds every save from before the sharded mode. The room list can change
+# freely. It listens on shard_base_port itself, or where "saves_shard" says:
+#
+#   "saves_shard": {"host": "127.0.0.1", "port": 5100}
+
+default_base_port = 5100
+
+saves_shard_name = "saves"
+
+
+def get_shards(config) -> list:
+    if "shards" in config:
+        defs = config["shards"]
+    else:
+        defs = [{"name": f"room-{room['id']}", "rooms": [room["id"]]} for room in config["rooms"]]
+
+    base_port = config["shard_base_port"] if "shard_base_port" in config else default_base_port
+    shards = []
+    for i, shard in enumerate(defs):
+        if str(shard["name"]) == saves_shard_name:
+            raise ValueError(f"the shard name {saves_shard_name} is taken by the saves shard")
+        shards.append({
+            "name": str(shard["name"]),
+            "rooms": [int(room_id) for room_id in shard["rooms"]],
+            "host": shard["host"] if "host" in shard else "127.0.0.1",
+            "port": shard["port"] if "port" in shard else base_port + i + 1,
+        })
+    return shards
+
+
+def find_shard(shards, name) -> dict:
+    for shard in shards:
+        if shard["name"] == name:
+            return shard
+    raise ValueError(f"unknown shard {name}")
+
+
+# room id -> the shard that owns it
+def room_owners(shards) -> dict:
+    owners = {}
+    for shard in shards:
+        for room_id in shard["rooms"]:
+            owners[room_id] = shard
+    return owners
+
+
+def get_saves_shard(config) -> dict:
+    shard = config["saves_shard"] if "saves_shard" in config else {}
+    return {
+        "name": saves_shard_name,
+        "rooms": [],
+        "host": shard["host"] if "host" in shard else "127.0.0.1",
+        "port": shard["port"] if "port" in shard else (config["shard_base_port"] if "shard_base_port" in config else default_base_port),
+    }
+
+
+# the config a shard's server.py runs with: only its rooms, and its own data folders.
+# The saves shard has no rooms and keeps the top level folders.
+def shard_config(config, name) -> dict:
+    if name == saves_shard_name:
+        config = dict(config)
+        config["rooms"] = []
+        return config
+
+    shard = find_shard(get_shards(config), name)
+
+    config = dict(config)
+    config["rooms"] = [room for room in config["rooms"] if room["id"] in shard["rooms"]]
+    config["data_dir"] = os.path.join(config["data_dir"] if "data_dir" in config else "data", "shards", name)
+    config["backup_dir"] = os.path.join(config["backup_dir"] if "backup_dir" in config else "backups", "shards", name)
+    return config
@@ -43,4 +43,67 @@ def has_file(file_path: str) -> bool:
         file.close()
         return True
     except IOError:
-        return False
\ No newline at end of file
+        return False
+
+# Buckets keys by deadline at a fixed resolution so expiring idle entries costs
+# O(expired) instead of a scan over everything that's still alive.
+class TimingWheel:
+    def __init__(self, resolution: float = 1.0):
+        self.resolution = resolution
+        # slot -> set of keys
+        self.buckets = {}
+        # key -> (slot, deadline)
+        self.entries = {}
+        self.cursor = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def touch(self, key, deadline: float):
+        slot = int(deadline // self.resolution)
+        # slots behind the cursor are never visited again
+        if self.cursor is not None and slot < self.cursor:
+            slot = self.cursor
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] != slot:
+            self.remove_from_bucket(key, entry[0])
+        if entry is None or entry[0] != slot:
+            self.buckets.setdefault(slot, set()).add(key)
+        self.entries[key] = (slot, deadline)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.remove_from_bucket(key, entry[0])
+
+    def remove_from_bucket(self, key, slot):
+        bucket = self.buckets[slot]
+        bucket.discard(key)
+        if len(bucket) == 0:
+            del self.buckets[slot]
+
+    # removes and returns every key whose deadline is at or before now
+    def expire(self, now: float) -> list:
+        current = int(now // self.resolution)
+        if self.cursor is None or self.cursor > current:
+            self.cursor = current
+            slots = sorted(s for s in self.buckets if s <= current)
+        elif current - self.cursor > len(self.buckets):
+            slots = sorted(s for s in self.buckets if s <= current)
+        else:
+            slots = [s for s in range(self.cursor, current + 1) if s in self.buckets]
+
+        expired = []
+        for slot in slots:
+            bucket = self.buckets[slot]
+            for key in list(bucket):
+                if slot < current or self.entries[key][1] <= now:
+                    bucket.discard(key)
+                    del self.entries[key]
+                    expired.append(key)
+            if len(bucket) == 0:
+                del self.buckets[slot]
+
+        # the current slot may still hold keys that expire later in it
+        self.cursor = current
+        return expired
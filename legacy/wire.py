@@ -0,0 +1,206 @@
+import json
+import struct
+
+# Compact binary encoding of room user lists, served instead of JSON when the
+# client sends "Accept: application/x-tankmas-room".
+#
+# All integers are little-endian.
+#
+#   header    magic "TKR1", u8 flags (bit 0: full snapshot), u64 version, u32 tick rate
+#   strings   u16 count, then per string: u16 byte length + utf-8 bytes
+#   users     u16 count, then per user: u16 username index, u8 field mask,
+#             followed by the fields present in the mask, in mask bit order
+#   removed   u16 count, then a u16 username index each
+#
+# Field mask bits:
+#   0 x        f32
+#   1 y        f32
+#   2 sx       i8 (facing direction)
+#   3 costume  u16 string index
+#   4 data     u32 byte length + utf-8 JSON
+#   5 online   no payload, the bit is the value
+#   6 map      u16 string index
+#
+# In a delta only the fields that changed after the client's version are sent.
+# Timestamps are not part of the binary format.
+
+MIMETYPE = "application/x-tankmas-room"
+
+MAGIC = b"TKR1"
+
+FLAG_FULL = 1
+
+FIELD_X = 1
+FIELD_Y = 2
+FIELD_SX = 4
+FIELD_COSTUME = 8
+FIELD_DATA = 16
+FIELD_ONLINE = 32
+FIELD_MAP = 64
+
+header_struct = struct.Struct("<4sBQI")
+u8 = struct.Struct("<B")
+u16 = struct.Struct("<H")
+u32 = struct.Struct("<I")
+f32 = struct.Struct("<f")
+i8 = struct.Struct("<b")
+record_struct = struct.Struct("<HB")
+
+
+class WireError(Exception):
+    pass
+
+
+class StringTable:
+    def __init__(self):
+        self.strings = []
+        self.indexes = {}
+
+    def index(self, value) -> int:
+        i = self.indexes.get(value)
+        if i is None:
+            i = self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return i
+
+
+# the packed field, or None for a value the format can't carry; that field is
+# left out rather than failing the whole room
+def pack_number(fmt, value):
+    try:
+        return fmt.pack(value)
+    except (struct.error, TypeError, OverflowError):
+        return None
+
+def pack_facing(value):
+    try:
+        return i8.pack(max(-128, min(127, round(value))))
+    except (struct.error, TypeError, ValueError, OverflowError):
+        return None
+
+
+# users is the dict from get_room_changes; when since is given, fields whose
+# field_versions are not newer than it are left out
+def encode_room(users, removed, version, tick_rate, full, since = None) -> bytes:
+    strings = StringTable()
+    records = []
+
+    for username, user in users.items():
+        name_index = strings.index(username)
+        versions = user["field_versions"] if not full and since is not None and "field_versions" in user else None
+
+        def changed(field):
+            return user[field] is not None and (versions is None or versions[field] > since)
+
+        mask = 0
+        payload = []
+        packed = [
+            (FIELD_X, pack_number(f32, user["x"]) if changed("x") else None),
+            (FIELD_Y, pack_number(f32, user["y"]) if changed("y") else None),
+            (FIELD_SX, pack_facing(user["sx"]) if changed("sx") else None),
+        ]
+        for field, value in packed:
+            if value is not None:
+                mask |= field
+                payload.append(value)
+        if changed("costume"):
+            mask |= FIELD_COSTUME
+            payload.append(u16.pack(strings.index(user["costume"])))
+        if changed("data") and user["data"] != {}:
+            mask |= FIELD_DATA
+            data = json.dumps(user["data"], separators=(",", ":")).encode()
+            payload.append(u32.pack(len(data)))
+            payload.append(data)
+        if user["online"]:
+            mask |= FIELD_ONLINE
+        if "map" in user and changed("map"):
+            mask |= FIELD_MAP
+            payload.append(u16.pack(strings.index(user["map"])))
+
+        records.append(record_struct.pack(name_index, mask))
+        records.extend(payload)
+
+    removed_indexes = [u16.pack(strings.index(username)) for username in removed]
+
+    if len(strings.strings) > 0xFFFF:
+        raise WireError("too many strings for one room payload")
+
+    out = [header_struct.pack(MAGIC, FLAG_FULL if full else 0, version, int(tick_rate))]
+    out.append(u16.pack(len(strings.strings)))
+    for value in strings.strings:
+        encoded = str(value).encode()
+        out.append(u16.pack(len(encoded)))
+        out.append(encoded)
+    out.append(u16.pack(len(users)))
+    out.extend(records)
+    out.append(u16.pack(len(removed_indexes)))
+    out.extend(removed_indexes)
+
+    return b"".join(out)
+
+
+def decode_room(payload) -> dict:
+    view = memoryview(payload)
+    try:
+        magic, flags, version, tick_rate = header_struct.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise WireError("not a room payload")
+        offset = header_struct.size
+
+        (count,) = u16.unpack_from(view, offset)
+        offset += 2
+        strings = []
+        for _ in range(count):
+            (length,) = u16.unpack_from(view, offset)
+            offset += 2
+            strings.append(bytes(view[offset:offset + length]).decode())
+            offset += length
+
+        users = {}
+        (count,) = u16.unpack_from(view, offset)
+        offset += 2
+        for _ in range(count):
+            name_index, mask = record_struct.unpack_from(view, offset)
+            offset += record_struct.size
+            user = {"username": strings[name_index], "online": bool(mask & FIELD_ONLINE)}
+            if mask & FIELD_X:
+                (user["x"],) = f32.unpack_from(view, offset)
+                offset += 4
+            if mask & FIELD_Y:
+                (user["y"],) = f32.unpack_from(view, offset)
+                offset += 4
+            if mask & FIELD_SX:
+                (user["sx"],) = i8.unpack_from(view, offset)
+                offset += 1
+            if mask & FIELD_COSTUME:
+                (costume_index,) = u16.unpack_from(view, offset)
+                offset += 2
+                user["costume"] = strings[costume_index]
+            if mask & FIELD_DATA:
+                (length,) = u32.unpack_from(view, offset)
+                offset += 4
+                user["data"] = json.loads(bytes(view[offset:offset + length]))
+                offset += length
+            if mask & FIELD_MAP:
+                (map_index,) = u16.unpack_from(view, offset)
+                offset += 2
+                user["map"] = strings[map_index]
+            users[user["username"]] = user
+
+        removed = []
+        (count,) = u16.unpack_from(view, offset)
+        offset += 2
+        for _ in range(count):
+            (name_index,) = u16.unpack_from(view, offset)
+            offset += 2
+            removed.append(strings[name_index])
+    except (struct.error, IndexError, UnicodeDecodeError, ValueError) as e:
+        raise WireError(f"malformed room payload: {e}")
+
+    return {
+        "version": version,
+        "tick_rate": tick_rate,
+        "full": bool(flags & FLAG_FULL),
+        "users": users,
+        "removed": removed,
+    }